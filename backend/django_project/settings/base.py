@@ -223,6 +223,31 @@ DATABASES = {
     "default": env.db_url("DATABASE_URL", default="sqlite:///tmp/build.db")
 }
 
+# Cache - must be shared (Redis) in production so every worker sees the same
+# face swap slots, progress events, idempotency records, counters and cleanup lease.
+# LocMem is per process; prod.py refuses to start with it.
+CACHE_URL = env('CACHE_URL', default='')
+CACHE_KEY_PREFIX = ''
+if not CACHE_URL and env('CELERY_BROKER_URL', default='').startswith(('redis://', 'rediss://')):
+    # Share the Celery broker's Redis, keeping our keys apart from kombu's
+    CACHE_URL = env('CELERY_BROKER_URL')
+    CACHE_KEY_PREFIX = 'cache'
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+            'KEY_PREFIX': CACHE_KEY_PREFIX,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    print("⚠️  CACHE_URL not set - using per-process LocMem cache")
+
 # Auth
 AUTH_USER_MODEL = 'accounts.CustomUser'
 AUTHENTICATION_BACKENDS = [
@@ -350,6 +375,65 @@ REST_FRAMEWORK = {
 HUGGINGFACE_SPACE_NAME = env('HUGGINGFACE_SPACE_NAME', default='mnraynor90/facefusionfastapi-private')
 HUGGINGFACE_API_TOKEN = env("HUGGINGFACE_API_TOKEN", default="dummy")
 
+# Face swap concurrency - slots and the admission queue are shared through the cache
+# The live limit adapts (AIMD) between MIN and MAX based on swap latency and errors
+FACE_SWAP_MIN_CONCURRENT_JOBS = env.int('FACE_SWAP_MIN_CONCURRENT_JOBS', default=1)
+FACE_SWAP_INITIAL_CONCURRENT_JOBS = env.int('FACE_SWAP_INITIAL_CONCURRENT_JOBS', default=2)
+FACE_SWAP_MAX_CONCURRENT_JOBS = env.int('FACE_SWAP_MAX_CONCURRENT_JOBS', default=6)
+FACE_SWAP_TARGET_LATENCY = env.int('FACE_SWAP_TARGET_LATENCY', default=45)  # seconds
+FACE_SWAP_MAX_ERROR_RATE = env.float('FACE_SWAP_MAX_ERROR_RATE', default=0.2)
+FACE_SWAP_LEASE_SECONDS = env.int('FACE_SWAP_LEASE_SECONDS', default=60)
+FACE_SWAP_QUEUE_SIZE = env.int('FACE_SWAP_QUEUE_SIZE', default=10)
+FACE_SWAP_QUEUE_MAX_WAIT = env.int('FACE_SWAP_QUEUE_MAX_WAIT', default=20)
+# Weighted fair queuing between traffic classes; reserved slots are only usable by signed-in users
+FACE_SWAP_PRIORITY_WEIGHTS = {
+    'authenticated': env.int('FACE_SWAP_WEIGHT_AUTHENTICATED', default=6),
+    'anonymous': env.int('FACE_SWAP_WEIGHT_ANONYMOUS', default=2),
+    'batch': env.int('FACE_SWAP_WEIGHT_BATCH', default=1),
+}
+FACE_SWAP_RESERVED_SLOTS = env.int('FACE_SWAP_RESERVED_SLOTS', default=1)
+
+# Image generation - write the GeneratedImage row once, after a successful swap
+IMAGEGEN_DEFER_PERSISTENCE = env.bool('IMAGEGEN_DEFER_PERSISTENCE', default=True)
+# Selfie uploads are streamed with a byte cap, header probe and disk spooling
+SELFIE_MAX_UPLOAD_BYTES = env.int('SELFIE_MAX_UPLOAD_BYTES', default=15 * 1024 * 1024)
+SELFIE_SPOOL_THRESHOLD = env.int('SELFIE_SPOOL_THRESHOLD', default=2 * 1024 * 1024)
+SELFIE_MAX_PIXELS = env.int('SELFIE_MAX_PIXELS', default=50_000_000)
+# Stored selfies and results: format (jpeg/webp/avif) and byte budgets the quality search aims for
+IMAGEGEN_OUTPUT_FORMAT = env('IMAGEGEN_OUTPUT_FORMAT', default='webp')
+IMAGEGEN_SELFIE_BYTE_BUDGET = env.int('IMAGEGEN_SELFIE_BYTE_BUDGET', default=120 * 1024)
+IMAGEGEN_RESULT_BYTE_BUDGET = env.int('IMAGEGEN_RESULT_BYTE_BUDGET', default=250 * 1024)
+# Randomize quality gate: downscaled face detection, minimum face size, Laplacian blur score
+SELFIE_GATE_ENABLED = env.bool('SELFIE_GATE_ENABLED', default=True)
+SELFIE_GATE_DETECT_SIZE = env.int('SELFIE_GATE_DETECT_SIZE', default=320)
+SELFIE_GATE_MIN_FACE_FRACTION = env.float('SELFIE_GATE_MIN_FACE_FRACTION', default=0.1)
+SELFIE_GATE_MIN_SHARPNESS = env.float('SELFIE_GATE_MIN_SHARPNESS', default=40.0)
+# Image history (/api/imagegen/list/) cursor pagination
+IMAGEGEN_HISTORY_PAGE_SIZE = env.int('IMAGEGEN_HISTORY_PAGE_SIZE', default=20)
+IMAGEGEN_HISTORY_MAX_PAGE_SIZE = env.int('IMAGEGEN_HISTORY_MAX_PAGE_SIZE', default=100)
+# Anonymous quota: imagegen.quota.DatabaseQuotaBackend (sessions + UsageSession rows) or
+# imagegen.quota.CacheQuotaBackend (signed token + cache counters, DB-free hot path)
+IMAGEGEN_QUOTA_BACKEND = env('IMAGEGEN_QUOTA_BACKEND', default='imagegen.quota.DatabaseQuotaBackend')
+IMAGEGEN_QUOTA_TTL = env.int('IMAGEGEN_QUOTA_TTL', default=30 * 24 * 60 * 60)
+IMAGEGEN_QUOTA_WRITE_BEHIND = env.bool('IMAGEGEN_QUOTA_WRITE_BEHIND', default=True)
+# Stale row purge: UsageSession retention and batch size/pause for the throttled deletes
+USAGE_SESSION_RETENTION_DAYS = env.int('USAGE_SESSION_RETENTION_DAYS', default=30)
+PURGE_BATCH_SIZE = env.int('PURGE_BATCH_SIZE', default=1000)
+PURGE_BATCH_PAUSE = env.float('PURGE_BATCH_PAUSE', default=0.2)
+# Expired image cleanup: Admin API client (imagegen.cloudinary_cleanup.FakeCloudinary for local runs)
+IMAGEGEN_CLOUDINARY_CLIENT = env('IMAGEGEN_CLOUDINARY_CLIENT', default='imagegen.cloudinary_cleanup.CloudinaryAdminClient')
+# Cleanup worker threads per run, and the Admin API call budget shared by every cleaner
+IMAGEGEN_CLEANUP_WORKERS = env.int('IMAGEGEN_CLEANUP_WORKERS', default=4)
+IMAGEGEN_CLOUDINARY_CALLS_PER_MINUTE = env.int('IMAGEGEN_CLOUDINARY_CALLS_PER_MINUTE', default=8)
+# One cleaner cluster-wide: seconds between runs and the leader lease TTL (takeover time)
+IMAGEGEN_CLEANUP_INTERVAL = env.int('IMAGEGEN_CLEANUP_INTERVAL', default=24 * 60 * 60)
+IMAGEGEN_CLEANUP_LEADER_TTL = env.int('IMAGEGEN_CLEANUP_LEADER_TTL', default=60)
+# Event-driven expiry: one Celery ETA task per bucket of expiry times (the scans above are the safety net)
+IMAGEGEN_EXPIRY_SCHEDULING = env.bool('IMAGEGEN_EXPIRY_SCHEDULING', default=True)
+IMAGEGEN_EXPIRY_BUCKET_SECONDS = env.int('IMAGEGEN_EXPIRY_BUCKET_SECONDS', default=60 * 60)
+IMAGEGEN_EXPIRY_MAX_ETA = env.int('IMAGEGEN_EXPIRY_MAX_ETA', default=45 * 60)  # Below the Redis visibility timeout
+IMAGEGEN_EXPIRY_SCHEDULE_RETRY = env.int('IMAGEGEN_EXPIRY_SCHEDULE_RETRY', default=5 * 60)  # Backoff after a failed enqueue
+
 print(f"🔧 HuggingFace Space: {HUGGINGFACE_SPACE_NAME}")
 print(f"🔑 HuggingFace Token: {'***configured***' if HUGGINGFACE_API_TOKEN != 'dummy' else 'NOT SET'}")
 
@@ -452,9 +536,19 @@ from celery.schedules import crontab
 CELERY_BEAT_SCHEDULE = {
     'cleanup-expired-images': {
         'task': 'imagegen.tasks.cleanup_expired_images_task',
-        'schedule': crontab(minute=0, hour='*/6'),  # Every 6 hours
+        'schedule': crontab(minute=0, hour=4),  # Daily safety net; expiry is event-driven
         'options': {'expires': 60 * 60}  # Task expires in 1 hour if not picked up
     },
+    'flush-quota-usage': {
+        'task': 'imagegen.tasks.flush_quota_usage_task',
+        'schedule': crontab(minute='*/5'),  # Cache quota write-behind
+        'options': {'expires': 5 * 60}
+    },
+    'purge-stale-sessions': {
+        'task': 'imagegen.tasks.purge_stale_sessions_task',
+        'schedule': crontab(minute=30, hour=3),  # Daily, off-peak
+        'options': {'expires': 60 * 60}
+    },
 }
 
 # Fix session cookies for frontend - IMPROVED
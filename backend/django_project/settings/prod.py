@@ -19,6 +19,14 @@ SECURE_HSTS_PRELOAD = True
 SESSION_COOKIE_SECURE = True
 CSRF_COOKIE_SECURE = True
 
+# ---------------- CACHE ----------------
+# Face swap slots, progress streams, quotas and the cleanup lease must be shared by every process
+if CACHES["default"]["BACKEND"].endswith("LocMemCache"):
+    raise ImproperlyConfigured(
+        "CACHE_URL (or a redis:// CELERY_BROKER_URL) must be set in production - "
+        "a per-process cache breaks the cluster-wide limits, progress streams and cleanup lease"
+    )
+
 # ---------------- STATIC FILES ----------------
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 STATIC_ROOT = BASE_DIR / "staticfiles"
@@ -19,6 +19,13 @@ EMAIL_HOST_PASSWORD = ""
 DEFAULT_FROM_EMAIL = "test@example.com"
 
 
+# Per-process cache; tests run in one process
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
 # In-memory test DB
 DATABASES = {
     "default": {
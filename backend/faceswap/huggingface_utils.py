@@ -317,13 +317,16 @@ def process_face_swap(job_id):
     """
     from .models import FaceSwapJob
     from django.utils import timezone
+    from imagegen.progress import publish, faceswap_channel
     
     log_memory_usage("job_start")
+    channel = faceswap_channel(job_id)
     
     try:
         job = FaceSwapJob.objects.get(id=job_id)
         job.status = 'processing'
         job.save()
+        publish(channel, 'processing')
         
         print(f"🚀 Processing face swap job {job_id} with improved Gradio client")
         
@@ -336,17 +339,20 @@ def process_face_swap(job_id):
             raise Exception(f"Connection test failed: {connection_test['error']}")
         
         # Perform face swap
+        publish(channel, 'swapping')
         result_image_data = client.swap_faces(job.source_image, job.target_image)
         
         # Save result
         result_filename = f"faceswap_result_{job.id}_{int(time.time())}.jpg"
         result_file = ContentFile(result_image_data, name=result_filename)
         job.result_image.save(result_filename, result_file)
+        publish(channel, 'saved')
         
         # Update status
         job.status = 'completed'
         job.completed_at = timezone.now()
         job.save()
+        publish(channel, 'completed', id=job.id, result_image=job.result_image.url)
         
         log_memory_usage("job_complete")
         print(f"✅ Face swap job {job_id} completed successfully")
@@ -363,6 +369,7 @@ def process_face_swap(job_id):
             job.save()
         except:
             pass
+        publish(channel, 'failed', error=str(e))
         return False
     finally:
         # 🔥 NEW: Force cleanup
@@ -4,6 +4,7 @@ from .views import (
     FaceSwapListView, 
     FaceSwapDetailView,
     FaceSwapStatusView,
+    FaceSwapProgressStreamView,
 )
 
 app_name = "faceswap"
@@ -13,4 +14,5 @@ urlpatterns = [
     path("jobs/", FaceSwapListView.as_view(), name="list"),
     path("jobs/<int:pk>/", FaceSwapDetailView.as_view(), name="detail"),
     path("status/<int:job_id>/", FaceSwapStatusView.as_view(), name="status"),
+    path("progress/<int:job_id>/", FaceSwapProgressStreamView.as_view(), name="progress"),
 ]
\ No newline at end of file
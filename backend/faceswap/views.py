@@ -2,10 +2,13 @@ from rest_framework import generics, status, permissions
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
+from rest_framework.renderers import JSONRenderer
 from django.shortcuts import get_object_or_404
 from .models import FaceSwapJob
 from .serializers import FaceSwapJobSerializer, FaceSwapCreateSerializer
 from .huggingface_utils import process_face_swap
+from imagegen.progress import EventStreamRenderer, faceswap_channel, streaming_response
+from imagegen.idempotency import idempotent
 import threading
 
 
@@ -17,6 +20,7 @@ class FaceSwapCreateView(generics.CreateAPIView):
     serializer_class = FaceSwapCreateSerializer
     permission_classes = [IsAuthenticated]
     
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -77,4 +81,22 @@ class FaceSwapStatusView(APIView):
             'result_image': job.result_image.url if job.result_image else None,
             'created_at': job.created_at,
             'completed_at': job.completed_at
-        })
\ No newline at end of file
+        })
+
+
+class FaceSwapProgressStreamView(APIView):
+    """
+    GET /api/faceswap/progress/{id}/
+    Server-Sent Events stream of job stages, replacing status polling
+    """
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [EventStreamRenderer, JSONRenderer]
+
+    def get(self, request, job_id):
+        job = get_object_or_404(FaceSwapJob, id=job_id, user=request.user)
+        snapshot = {'stage': job.status, 'id': job.id}
+        if job.status == 'completed' and job.result_image:
+            snapshot['result_image'] = job.result_image.url
+        elif job.status == 'failed':
+            snapshot['error'] = job.error_message
+        return streaming_response(faceswap_channel(job.id), request, snapshot)
@@ -3,47 +3,81 @@ import threading
 import time
 import logging
 from django.conf import settings
-from django.utils import timezone
+from django.core.cache import cache
+from django.db import connection
+from .concurrency import LeaderLease
 
 logger = logging.getLogger(__name__)
 
+# Time between cleanup runs, cluster-wide; a safety net behind the per-bucket expiry tasks
+CLEANUP_INTERVAL = getattr(settings, 'IMAGEGEN_CLEANUP_INTERVAL', 24 * 60 * 60)
+# A dead leader is replaced within this many seconds
+LEADER_TTL = getattr(settings, 'IMAGEGEN_CLEANUP_LEADER_TTL', 60)
+LEADER_NAME = 'image-cleanup'
+LAST_RUN_KEY = 'image-cleanup:last-run'
+
+
+def cleanup_is_due():
+    last_run = cache.get(LAST_RUN_KEY)
+    return last_run is None or time.time() - last_run >= CLEANUP_INTERVAL
+
+
+def mark_cleanup_run():
+    cache.set(LAST_RUN_KEY, time.time(), timeout=None)
+
+
 class BackgroundCleanupThread(threading.Thread):
-    """Background thread that periodically cleans up expired images"""
+    """
+    Background thread that periodically cleans up expired images.
+
+    Every gunicorn worker runs one, but only the elected leader cleans: the
+    threads compete for leadership (a Postgres advisory lock, or a cache
+    lease on other databases) every LEADER_TTL/2 seconds, and the
+    leader runs cleanup once CLEANUP_INTERVAL has passed since the last run
+    anywhere in the cluster (including the Celery beat task).
+    """
     
     def __init__(self):
         super().__init__(daemon=True)  # Daemon thread dies when main program exits
         self.stop_event = threading.Event()
-        self.cleanup_interval = 6 * 60 * 60  # 6 hours in seconds
+        self.leader = LeaderLease(LEADER_NAME, ttl=LEADER_TTL)
         
     def run(self):
         logger.info("🧹 Background cleanup thread started")
         
         while not self.stop_event.is_set():
             try:
-                # Wait for the interval or until stop is requested
-                if self.stop_event.wait(self.cleanup_interval):
+                # Poll often enough to take over promptly from a dead leader
+                if self.stop_event.wait(LEADER_TTL / 2):
                     break  # Stop event was set
                 
+                if not self.leader.acquire():
+                    # Followers don't need to keep a database connection open between polls
+                    connection.close()
+                    continue
+                if not cleanup_is_due():
+                    continue
+                
                 # Perform cleanup
                 self.cleanup_expired_images()
+                mark_cleanup_run()
                 
             except Exception as e:
                 logger.error(f"❌ Background cleanup error: {e}")
                 # Continue running even if there's an error
+        
+        # Released from this thread: an advisory lock belongs to this thread's connection
+        self.leader.release()
     
     def cleanup_expired_images(self):
         """Clean up expired images"""
         try:
             from .models import GeneratedImage
+            from .cloudinary_cleanup import cleanup_expired_images
             
             logger.info("🧹 Starting background cleanup of expired images")
             
-            now = timezone.now()
-            expired_images = GeneratedImage.objects.filter(
-                expires_at__lt=now,
-                is_expired=False,
-                cleanup_attempted=False
-            )
+            expired_images = GeneratedImage.objects.due_for_cleanup()
             
             count = expired_images.count()
             logger.info(f"📊 Found {count} expired images to clean up")
@@ -52,17 +86,7 @@ class BackgroundCleanupThread(threading.Thread):
                 logger.info("✅ No expired images found")
                 return
             
-            deleted_count = 0
-            failed_count = 0
-            
-            for img in expired_images:
-                try:
-                    deleted_files = img.expire_and_cleanup()
-                    deleted_count += 1
-                    logger.info(f"✅ Cleaned up image {img.id}: {deleted_files}")
-                except Exception as e:
-                    failed_count += 1
-                    logger.error(f"❌ Failed to cleanup image {img.id}: {e}")
+            deleted_count, failed_count = cleanup_expired_images(expired_images)
             
             logger.info(f"🎉 Background cleanup completed: {deleted_count} deleted, {failed_count} failed")
             
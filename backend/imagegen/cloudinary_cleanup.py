@@ -0,0 +1,230 @@
+# imagegen/cloudinary_cleanup.py - Batched deletion of expired images through the Cloudinary Admin API
+
+import logging
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import GeneratedImage
+from .concurrency import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Admin API limit for delete_resources
+MAX_IDS_PER_CALL = 100
+# Rows per cleanup batch; two files each, so one batch fills one API call
+ROWS_PER_BATCH = MAX_IDS_PER_CALL // 2
+CLOUDINARY_CLIENT = getattr(settings, 'IMAGEGEN_CLOUDINARY_CLIENT', 'imagegen.cloudinary_cleanup.CloudinaryAdminClient')
+# Per-id results that mean the file is gone
+GONE = ('deleted', 'not_found')
+# Threads claiming and cleaning batches in one run
+CLEANUP_WORKERS = getattr(settings, 'IMAGEGEN_CLEANUP_WORKERS', 4)
+# Shared by every cleaner in the cluster (the Admin API allows 500 calls/hour by default)
+CALLS_PER_MINUTE = getattr(settings, 'IMAGEGEN_CLOUDINARY_CALLS_PER_MINUTE', 8)
+# A worker stops instead of waiting longer than this for the rate limit
+RATE_LIMIT_WAIT = 2 * 60
+# A claim older than this is presumed abandoned (its cleaner died) and can be taken again
+CLAIM_TTL = timedelta(minutes=10)
+
+admin_api_rate_limit = RateLimiter('cloudinary-admin', CALLS_PER_MINUTE, per=60)
+
+
+class RateLimited(Exception):
+    """The Admin API budget is used up for longer than RATE_LIMIT_WAIT"""
+
+
+class CloudinaryAdminClient:
+    """The real Admin API"""
+
+    def delete_resources(self, public_ids):
+        import cloudinary.api
+        return cloudinary.api.delete_resources(list(public_ids), resource_type='image')
+
+
+class FakeCloudinary:
+    """
+    In-memory stand-in for the Admin API, for local runs and exercising the
+    batching (IMAGEGEN_CLOUDINARY_CLIENT=imagegen.cloudinary_cleanup.FakeCloudinary).
+
+    - `calls` records the public_ids of every delete_resources call
+    - ids in `failing_ids` are left out of the response, like a partial delete
+    - `error`, if set, is raised by the next call (a failed request)
+    """
+
+    def __init__(self, failing_ids=()):
+        self.calls = []
+        self.deleted = set()
+        self.failing_ids = set(failing_ids)
+        self.error = None
+
+    def delete_resources(self, public_ids):
+        public_ids = list(public_ids)
+        if len(public_ids) > MAX_IDS_PER_CALL:
+            raise ValueError(f"delete_resources accepts at most {MAX_IDS_PER_CALL} public_ids")
+        self.calls.append(public_ids)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+        results = {}
+        for public_id in public_ids:
+            if public_id in self.failing_ids:
+                continue
+            results[public_id] = 'not_found' if public_id in self.deleted else 'deleted'
+            self.deleted.add(public_id)
+        return {'deleted': results, 'partial': len(results) < len(public_ids)}
+
+
+@lru_cache(maxsize=None)
+def get_cloudinary_client():
+    return import_string(CLOUDINARY_CLIENT)()
+
+
+def delete_public_ids(public_ids, client=None):
+    """
+    Delete public_ids MAX_IDS_PER_CALL at a time, each call under the
+    cluster-wide Admin API rate limit. Returns the set that is confirmed
+    gone; a failed call only loses its own chunk.
+    Raises RateLimited if the rate limit doesn't free up in time.
+    """
+    client = client or get_cloudinary_client()
+    public_ids = list(dict.fromkeys(public_ids))
+    gone = set()
+
+    for start in range(0, len(public_ids), MAX_IDS_PER_CALL):
+        chunk = public_ids[start:start + MAX_IDS_PER_CALL]
+        if not admin_api_rate_limit.acquire(timeout=RATE_LIMIT_WAIT):
+            raise RateLimited(f"No Cloudinary Admin API budget within {RATE_LIMIT_WAIT}s")
+        try:
+            result = client.delete_resources(chunk)
+        except Exception as e:
+            logger.error(f"❌ Cloudinary delete_resources failed for {len(chunk)} files: {e}")
+            continue
+        statuses = result.get('deleted', {})
+        chunk_gone = {public_id for public_id in chunk if statuses.get(public_id) in GONE}
+        if len(chunk_gone) < len(chunk):
+            logger.warning(f"⚠️ Cloudinary did not delete {len(chunk) - len(chunk_gone)} of {len(chunk)} files")
+        gone |= chunk_gone
+    return gone
+
+
+def public_ids_for(image):
+    """Public_ids of an image's stored files (stored columns, else derived)"""
+    public_ids = []
+    if image.selfie:
+        public_ids.append(image.selfie_public_id or image.get_image_public_id(image.selfie))
+    if image.output_image:
+        public_ids.append(image.output_public_id or image.get_image_public_id(image.output_image))
+    return [public_id for public_id in public_ids if public_id]
+
+
+def cleanup_batch(images, client=None):
+    """
+    Delete the files of `images` in bulk and mark every row whose files are
+    all gone with a single UPDATE. Rows with a failed file stay due (and lose
+    their claim), so the next run retries them. Returns (cleaned ids, failed ids).
+    """
+    wanted = {image.id: public_ids_for(image) for image in images}
+    gone = delete_public_ids([pid for pids in wanted.values() for pid in pids], client)
+
+    cleaned, failed = [], []
+    for image_id, pids in wanted.items():
+        (cleaned if all(pid in gone for pid in pids) else failed).append(image_id)
+    if cleaned:
+        GeneratedImage.objects.filter(id__in=cleaned).update(
+            is_expired=True, cleanup_attempted=True, cleanup_claimed_at=None
+        )
+    if failed:
+        GeneratedImage.objects.filter(id__in=failed).update(cleanup_claimed_at=None)
+    logger.info(f"🗑️ Cleaned up {len(cleaned)} images in bulk ({len(failed)} failed)")
+    return cleaned, failed
+
+
+def _claim(queryset, exclude, skip_locked):
+    """
+    Claim up to ROWS_PER_BATCH due rows in one short transaction: lock them
+    with SELECT ... FOR UPDATE SKIP LOCKED, stamp cleanup_claimed_at and
+    commit. Rate limiting and the API call happen after the commit, so no
+    transaction stays open while a cleaner waits.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        claimable = queryset.exclude(id__in=exclude).filter(
+            Q(cleanup_claimed_at__isnull=True) | Q(cleanup_claimed_at__lt=now - CLAIM_TTL)
+        )
+        if skip_locked:
+            claimable = claimable.select_for_update(skip_locked=True)
+        batch = list(claimable[:ROWS_PER_BATCH])
+        if batch:
+            GeneratedImage.objects.filter(id__in=[image.id for image in batch]).update(cleanup_claimed_at=now)
+    return batch
+
+
+def _claim_and_clean(queryset, client, failed_ids, lock, skip_locked):
+    """Claim a batch and clean it. Returns the cleaned ids, or None when nothing is left to claim."""
+    with lock:
+        exclude = list(failed_ids)
+    batch = _claim(queryset, exclude, skip_locked)
+    if not batch:
+        return None
+    try:
+        cleaned, failed = cleanup_batch(batch, client)
+    except RateLimited:
+        # Hand the batch back rather than leave it claimed until CLAIM_TTL
+        GeneratedImage.objects.filter(id__in=[image.id for image in batch]).update(cleanup_claimed_at=None)
+        raise
+    with lock:
+        failed_ids.update(failed)
+    return cleaned
+
+
+def _cleanup_worker(queryset, client, failed_ids, lock, skip_locked, own_connection):
+    cleaned_count = 0
+    try:
+        while True:
+            cleaned = _claim_and_clean(queryset, client, failed_ids, lock, skip_locked)
+            if cleaned is None:
+                break
+            cleaned_count += len(cleaned)
+    except RateLimited as e:
+        logger.warning(f"⚠️ Cleanup worker stopping: {e}")
+    finally:
+        if own_connection:
+            connection.close()
+    return cleaned_count
+
+
+def cleanup_expired_images(queryset=None, client=None, workers=None):
+    """
+    Clean up every due image. Worker threads each claim ROWS_PER_BATCH rows
+    (one API call) at a time - SKIP LOCKED plus a committed claim stamp - so
+    any number of cleaners - other threads, the beat task, the background
+    thread, manual runs - can drain the backlog together without
+    double-deleting. Databases without SKIP LOCKED get one serial worker.
+    Returns (cleaned count, failed count).
+    """
+    queryset = GeneratedImage.objects.due_for_cleanup() if queryset is None else queryset
+    queryset = queryset.only('id', 'selfie', 'selfie_public_id', 'output_image', 'output_public_id')
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    workers = (workers or CLEANUP_WORKERS) if skip_locked else 1
+    failed_ids = set()
+    lock = threading.Lock()
+
+    if workers == 1:
+        cleaned_count = _cleanup_worker(queryset, client, failed_ids, lock, skip_locked, own_connection=False)
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cleanup') as pool:
+            futures = [
+                pool.submit(_cleanup_worker, queryset, client, failed_ids, lock, skip_locked, True)
+                for _ in range(workers)
+            ]
+            cleaned_count = sum(future.result() for future in futures)
+
+    logger.info(f"🎉 Cleanup run finished: {cleaned_count} cleaned, {len(failed_ids)} failed "
+                f"({workers} workers)")
+    return cleaned_count, len(failed_ids)
@@ -0,0 +1,642 @@
+# imagegen/concurrency.py - Cluster-wide face swap concurrency limiting
+
+import math
+import time
+import hashlib
+import uuid
+import threading
+import logging
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Adaptive (AIMD) limit bounds - the live limit moves between these
+MIN_CONCURRENT_JOBS = getattr(settings, 'FACE_SWAP_MIN_CONCURRENT_JOBS', 1)
+INITIAL_CONCURRENT_JOBS = getattr(settings, 'FACE_SWAP_INITIAL_CONCURRENT_JOBS', 2)
+MAX_CONCURRENT_JOBS = getattr(settings, 'FACE_SWAP_MAX_CONCURRENT_JOBS', 6)
+TARGET_LATENCY = getattr(settings, 'FACE_SWAP_TARGET_LATENCY', 45)
+MAX_ERROR_RATE = getattr(settings, 'FACE_SWAP_MAX_ERROR_RATE', 0.2)
+LEASE_SECONDS = getattr(settings, 'FACE_SWAP_LEASE_SECONDS', 60)
+QUEUE_SIZE = getattr(settings, 'FACE_SWAP_QUEUE_SIZE', 10)
+QUEUE_MAX_WAIT = getattr(settings, 'FACE_SWAP_QUEUE_MAX_WAIT', 20)
+# Weighted fair queuing between traffic classes, plus slots held back for signed-in users
+PRIORITY_AUTHENTICATED = 'authenticated'
+PRIORITY_ANONYMOUS = 'anonymous'
+PRIORITY_BATCH = 'batch'
+PRIORITY_WEIGHTS = getattr(settings, 'FACE_SWAP_PRIORITY_WEIGHTS', {
+    PRIORITY_AUTHENTICATED: 6,
+    PRIORITY_ANONYMOUS: 2,
+    PRIORITY_BATCH: 1,
+})
+RESERVED_SLOTS = getattr(settings, 'FACE_SWAP_RESERVED_SLOTS', 1)
+# Heartbeats stop after this long so a leaked lease can't pin a slot forever
+MAX_HOLD_SECONDS = getattr(settings, 'FACE_SWAP_MAX_HOLD_SECONDS', 15 * 60)
+DEFAULT_SWAP_SECONDS = 30
+
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_ERROR = 'error'
+OUTCOME_OVERLOAD = 'overload'
+
+
+@contextmanager
+def cache_lock(key, timeout=5, wait=1.0):
+    """Short mutual-exclusion section over the cache; yields False if not acquired in time"""
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+    while not cache.add(key, token, timeout=timeout):
+        if time.monotonic() >= deadline:
+            yield False
+            return
+        time.sleep(0.01)
+    try:
+        yield True
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def classify_swap_error(error):
+    """Timeouts and rate limits mean the backend is overloaded; anything else is a plain error"""
+    message = str(error).lower()
+    overload_markers = ('rate limit', 'too many', 'slow down', 'timeout', 'timed out', '429', '503')
+    if isinstance(error, TimeoutError) or any(marker in message for marker in overload_markers):
+        return OUTCOME_OVERLOAD
+    return OUTCOME_ERROR
+
+
+class AdaptiveLimit:
+    """
+    Additive-increase / multiplicative-decrease concurrency limit kept in the cache.
+
+    Every successful swap under the latency target (with the recent error rate
+    under its target) adds 1/limit, i.e. roughly +1 per full window of swaps.
+    Timeouts and rate-limit errors multiply the limit by `decrease`.
+    Slow swaps and ordinary errors only hold the limit where it is.
+    """
+
+    history_size = 100
+
+    def __init__(self, name, initial=INITIAL_CONCURRENT_JOBS, min_limit=MIN_CONCURRENT_JOBS,
+                 max_limit=MAX_CONCURRENT_JOBS, target_latency=TARGET_LATENCY,
+                 max_error_rate=MAX_ERROR_RATE, increase=1.0, decrease=0.5):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.initial = min(max(initial, self.min_limit), self.max_limit)
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    @property
+    def _state_key(self):
+        return f"aimd:{self.name}:state"
+
+    @property
+    def _history_key(self):
+        return f"aimd:{self.name}:history"
+
+    @property
+    def _lock_key(self):
+        return f"aimd:{self.name}:lock"
+
+    def _state(self):
+        return cache.get(self._state_key) or {"limit": float(self.initial), "error_rate": 0.0}
+
+    @property
+    def current(self):
+        return int(self._state()["limit"])
+
+    def record(self, latency, outcome):
+        """Feed one swap result into the controller; returns the new integer limit"""
+        with cache_lock(self._lock_key) as locked:
+            state = self._state()
+            if not locked:
+                # Contended update - the next sample will adjust instead
+                return int(state["limit"])
+
+            old_limit = state["limit"]
+            failed = 0.0 if outcome == OUTCOME_SUCCESS else 1.0
+            state["error_rate"] = state["error_rate"] * 0.9 + failed * 0.1
+
+            if outcome == OUTCOME_OVERLOAD:
+                state["limit"] = max(self.min_limit, old_limit * self.decrease)
+                reason = "overload"
+            elif (outcome == OUTCOME_SUCCESS and latency <= self.target_latency
+                    and state["error_rate"] <= self.max_error_rate):
+                state["limit"] = min(self.max_limit, old_limit + self.increase / max(old_limit, 1))
+                reason = "healthy"
+            else:
+                reason = "hold"
+
+            cache.set(self._state_key, state, timeout=None)
+
+            if int(state["limit"]) != int(old_limit):
+                self._append_history(int(old_limit), int(state["limit"]), reason, latency)
+                logger.info(f"📈 Face swap limit {int(old_limit)} -> {int(state['limit'])} ({reason}, {latency:.1f}s)")
+
+            return int(state["limit"])
+
+    def _append_history(self, old_limit, new_limit, reason, latency):
+        history = cache.get(self._history_key) or []
+        history.append({
+            "at": timezone.now().isoformat(),
+            "from": old_limit,
+            "to": new_limit,
+            "reason": reason,
+            "latency": round(latency, 2),
+        })
+        cache.set(self._history_key, history[-self.history_size:], timeout=None)
+
+    def snapshot(self):
+        state = self._state()
+        return {
+            "limit": int(state["limit"]),
+            "limit_exact": round(state["limit"], 3),
+            "error_rate": round(state["error_rate"], 3),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "target_latency": self.target_latency,
+            "history": cache.get(self._history_key) or [],
+        }
+
+
+class AdmissionRejected(Exception):
+    """Raised when a caller cannot get a slot (queue full or waited too long)"""
+
+    def __init__(self, reason, position, eta_seconds):
+        super().__init__(reason)
+        self.reason = reason
+        self.position = position
+        self.eta_seconds = eta_seconds
+
+    @property
+    def retry_after(self):
+        return max(1, int(math.ceil(self.eta_seconds)))
+
+
+class Lease:
+    """
+    A held slot. A daemon thread keeps the lease alive while the holder runs;
+    if the process dies the key simply expires and the slot frees itself.
+    """
+
+    def __init__(self, semaphore, slot, token):
+        self.semaphore = semaphore
+        self.slot = slot
+        self.token = token
+        self.started = time.monotonic()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._keep_alive, daemon=True)
+        self._heartbeat.start()
+
+    def _keep_alive(self):
+        interval = max(1, self.semaphore.lease_seconds / 3)
+        while not self._stop.wait(interval):
+            if time.monotonic() - self.started > MAX_HOLD_SECONDS:
+                logger.warning(f"⚠️ Face swap slot {self.slot} held too long - letting lease expire")
+                return
+            if not self.semaphore.refresh(self):
+                logger.warning(f"⚠️ Lost face swap slot {self.slot} lease")
+                return
+
+    def release(self, duration=None):
+        """Free the slot; `duration` (how long the guarded work took) feeds the ETA average"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.semaphore.release(self, duration)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class DistributedSemaphore:
+    """
+    Counting semaphore shared through the Django cache.
+
+    Each slot is its own key claimed with cache.add() (SET NX on Redis), so
+    acquisition is atomic and a crashed holder only blocks a slot until its
+    lease expires.
+
+    Waiters queue per traffic class (authenticated, anonymous, batch). Within
+    a class they take tickets from an atomic counter and are admitted in
+    ticket order; every waiter keeps its ticket key alive while polling so
+    abandoned tickets drop out on their own. Between classes, free slots are
+    shared by stride scheduling (weighted fair queuing): each admission
+    advances the class's pass by 1/weight and the class with the lowest pass
+    goes next. A few slots can also be held back for authenticated users so
+    anonymous spikes never occupy the whole limit.
+    """
+
+    def __init__(self, name, limit=INITIAL_CONCURRENT_JOBS, lease_seconds=LEASE_SECONDS,
+                 queue_size=QUEUE_SIZE, max_wait=QUEUE_MAX_WAIT, poll_interval=0.25,
+                 weights=None, reserved_slots=RESERVED_SLOTS):
+        self.name = name
+        # Either a fixed int or an AdaptiveLimit
+        self._limit = limit
+        self.lease_seconds = lease_seconds
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.ticket_ttl = max(5, int(poll_interval * 20))
+        self.weights = weights or PRIORITY_WEIGHTS
+        self.reserved_slots = reserved_slots
+
+    # Keys
+    def _slot_key(self, slot):
+        return f"sem:{self.name}:slot:{slot}"
+
+    def _ticket_key(self, priority, ticket):
+        return f"sem:{self.name}:{priority}:ticket:{ticket}"
+
+    def _tail_key(self, priority):
+        return f"sem:{self.name}:{priority}:tail"
+
+    def _head_key(self, priority):
+        return f"sem:{self.name}:{priority}:head"
+
+    @property
+    def _passes_key(self):
+        return f"sem:{self.name}:passes"
+
+    @property
+    def _avg_key(self):
+        return f"sem:{self.name}:avg_seconds"
+
+    @property
+    def limit(self):
+        if isinstance(self._limit, AdaptiveLimit):
+            return self._limit.current
+        return self._limit
+
+    @property
+    def _slot_count(self):
+        # Slots above a freshly lowered limit may still be held; count them too
+        if isinstance(self._limit, AdaptiveLimit):
+            return self._limit.max_limit
+        return self._limit
+
+    def _normalize_priority(self, priority):
+        return priority if priority in self.weights else PRIORITY_ANONYMOUS
+
+    # Slots
+    def try_acquire(self):
+        """Claim a free slot without queueing; returns a Lease or None"""
+        token = uuid.uuid4().hex
+        for slot in range(self.limit):
+            if cache.add(self._slot_key(slot), token, timeout=self.lease_seconds):
+                return Lease(self, slot, token)
+        return None
+
+    def refresh(self, lease):
+        key = self._slot_key(lease.slot)
+        if cache.get(key) != lease.token:
+            return False
+        return cache.touch(key, self.lease_seconds)
+
+    def release(self, lease, duration=None):
+        key = self._slot_key(lease.slot)
+        # Only delete our own claim; if the lease already expired and another
+        # holder took the slot we must leave it alone.
+        if cache.get(key) == lease.token:
+            cache.delete(key)
+        if duration is not None:
+            self._record_duration(duration)
+
+    def active_count(self):
+        keys = [self._slot_key(slot) for slot in range(self._slot_count)]
+        return len(cache.get_many(keys))
+
+    # Queues
+    def _next_ticket(self, priority):
+        tail_key = self._tail_key(priority)
+        cache.add(tail_key, 0, timeout=None)
+        try:
+            return cache.incr(tail_key)
+        except ValueError:
+            cache.set(tail_key, 1, timeout=None)
+            return 1
+
+    def _position(self, priority, ticket):
+        """Live tickets of this class ahead of `ticket`; also advances the head past dead ones"""
+        head_key = self._head_key(priority)
+        # Bound the scan even if the head key was evicted
+        head = max(cache.get(head_key, 1), ticket - self.queue_size * 10)
+        if head >= ticket:
+            return 0
+
+        keys = [self._ticket_key(priority, t) for t in range(head, ticket)]
+        alive = cache.get_many(keys)
+
+        # Tickets never come back to life, so skipping leading dead ones is always safe
+        new_head = head
+        for key in keys:
+            if key in alive:
+                break
+            new_head += 1
+        if new_head != head:
+            cache.set(head_key, new_head, timeout=None)
+
+        return len(alive)
+
+    def queue_depth(self, priority):
+        tail = cache.get(self._tail_key(priority), 0)
+        return self._position(priority, tail + 1)
+
+    # Weighted fair queuing
+    def _passes(self):
+        return cache.get(self._passes_key) or {"_vtime": 0.0}
+
+    def _charge(self, priority):
+        """Advance the admitted class's pass by its stride (1/weight)"""
+        with cache_lock(f"{self._passes_key}:lock") as locked:
+            if not locked:
+                return
+            passes = self._passes()
+            # An idle class re-enters at the current virtual time instead of
+            # cashing in credit accumulated while it had no traffic.
+            current = max(passes.get(priority, 0.0), passes["_vtime"])
+            passes["_vtime"] = current
+            passes[priority] = current + 1.0 / self.weights[priority]
+            cache.set(self._passes_key, passes, timeout=None)
+
+    def _reserved(self, limit):
+        # Never reserve the last slot, or non-authenticated traffic would starve at limit 1
+        return max(0, min(self.reserved_slots, limit - 1))
+
+    def _admissible(self, priority, position):
+        """
+        Simulate stride scheduling over the free slots and report whether the
+        waiter at `position` of class `priority` is among those to be admitted.
+        """
+        limit = self.limit
+        free = limit - self.active_count()
+        if free <= 0:
+            return False
+
+        shared_free = free - self._reserved(limit)
+        depths = {cls: self.queue_depth(cls) for cls in self.weights}
+        depths[priority] = max(depths[priority], position + 1)
+
+        passes = self._passes()
+        vtime = passes["_vtime"]
+        virtual = {cls: max(passes.get(cls, 0.0), vtime) for cls in self.weights}
+        granted = {cls: 0 for cls in self.weights}
+
+        for pick in range(free):
+            candidates = [
+                cls for cls in self.weights
+                if granted[cls] < depths[cls]
+                and (cls == PRIORITY_AUTHENTICATED or pick < shared_free)
+            ]
+            if not candidates:
+                break
+            chosen = min(candidates, key=lambda cls: (virtual[cls], -self.weights[cls]))
+            granted[chosen] += 1
+            virtual[chosen] += 1.0 / self.weights[chosen]
+
+        return position < granted[priority]
+
+    def average_duration(self):
+        return cache.get(self._avg_key, DEFAULT_SWAP_SECONDS)
+
+    def _record_duration(self, duration):
+        # Exponentially weighted moving average; an advisory number for ETAs only
+        average = self.average_duration()
+        cache.set(self._avg_key, average * 0.8 + duration * 0.2, timeout=None)
+
+    def estimate_wait(self, position, priority=PRIORITY_ANONYMOUS):
+        """Rough ETA: the class drains at its weighted share of the limit"""
+        total_weight = sum(self.weights.values())
+        share = self.weights.get(priority, 1) / total_weight
+        throughput = max(self.limit * share, 0.5)
+        return (position / throughput + 1) * self.average_duration()
+
+    def acquire(self, priority=PRIORITY_ANONYMOUS, max_wait=None, on_wait=None, should_stop=None):
+        """
+        Wait for a slot in the queue of traffic class `priority`.
+        Raises AdmissionRejected if that queue is full, `max_wait` elapses or
+        `should_stop()` turns true (e.g. the caller's pipeline was cancelled).
+        `on_wait(position, eta_seconds)` is called whenever the position changes.
+        """
+        priority = self._normalize_priority(priority)
+        max_wait = self.max_wait if max_wait is None else max_wait
+        ticket = self._next_ticket(priority)
+        ticket_key = self._ticket_key(priority, ticket)
+        cache.set(ticket_key, 1, timeout=self.ticket_ttl)
+
+        try:
+            position = self._position(priority, ticket)
+            if position >= self.queue_size:
+                raise AdmissionRejected("queue_full", position, self.estimate_wait(position, priority))
+
+            deadline = time.monotonic() + max_wait
+            last_position = None
+            while True:
+                if self._admissible(priority, position):
+                    lease = self.try_acquire()
+                    if lease:
+                        self._charge(priority)
+                        return lease
+
+                if position != last_position:
+                    last_position = position
+                    if on_wait:
+                        on_wait(position, self.estimate_wait(position, priority))
+
+                if time.monotonic() >= deadline:
+                    raise AdmissionRejected("timeout", position, self.estimate_wait(position, priority))
+                if should_stop and should_stop():
+                    raise AdmissionRejected("cancelled", position, self.estimate_wait(position, priority))
+
+                time.sleep(self.poll_interval)
+                if not cache.touch(ticket_key, self.ticket_ttl):
+                    cache.set(ticket_key, 1, timeout=self.ticket_ttl)
+                position = self._position(priority, ticket)
+        finally:
+            cache.delete(ticket_key)
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active_count(),
+            "reserved_for_authenticated": self._reserved(self.limit),
+            "queued": {cls: self.queue_depth(cls) for cls in self.weights},
+            "weights": self.weights,
+            "average_seconds": round(self.average_duration(), 2),
+        }
+
+
+class RateLimiter:
+    """
+    Cluster-wide fixed-window rate limit over the cache: at most `rate`
+    acquisitions per `per` seconds across every process. Window counters are
+    created with cache.add() and bumped with cache.incr(), both atomic.
+    """
+
+    def __init__(self, name, rate, per=60):
+        self.name = name
+        self.rate = rate
+        self.per = per
+
+    def try_acquire(self):
+        """Returns (acquired, seconds until the next window)"""
+        now = time.time()
+        window = int(now // self.per)
+        key = f"ratelimit:{self.name}:{window}"
+        cache.add(key, 0, timeout=self.per * 2)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr()
+            cache.add(key, 0, timeout=self.per * 2)
+            count = cache.incr(key)
+        return count <= self.rate, (window + 1) * self.per - now
+
+    def acquire(self, timeout=None):
+        """Block until a call is allowed; False if that would take longer than `timeout`"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            acquired, wait = self.try_acquire()
+            if acquired:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            logger.debug(f"⏳ Rate limit {self.name} reached, waiting {wait:.1f}s")
+            time.sleep(wait)
+
+
+class LeaderLease:
+    """
+    Cluster-wide leadership: at most one holder of `name` at a time.
+
+    On PostgreSQL it is a session-level advisory lock (pg_try_advisory_lock).
+    The lock lives on the holder's database connection, so a dead leader's
+    lock is released with its connection and the next candidate to call
+    acquire() takes over. Acquire, re-check and release from the same thread.
+
+    On other databases the leader claims a cache key with cache.add(), and a
+    heartbeat thread renews it every ttl/3; a dead leader's key expires after
+    `ttl`. A per-process cache (LocMem) can't elect anyone cluster-wide, so
+    there acquire() always refuses.
+    """
+
+    def __init__(self, name, ttl=60):
+        self.name = name
+        self.ttl = ttl
+        self.key = f"leader:{name}"
+        self.token = uuid.uuid4().hex
+        # Advisory locks take a bigint key
+        self.lock_id = int.from_bytes(hashlib.sha256(self.key.encode()).digest()[:8], 'big', signed=True)
+        self._held_on = None
+        self._warned_local_cache = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @staticmethod
+    def _use_advisory_lock():
+        return connection.vendor == 'postgresql'
+
+    def acquire(self):
+        """Become leader, or stay leader if we already are. Returns whether we lead."""
+        if self._use_advisory_lock():
+            return self._acquire_advisory_lock()
+        if isinstance(caches['default'], LocMemCache):
+            if not self._warned_local_cache:
+                logger.warning(f"⚠️ Not electing a {self.name} leader: the cache is per-process (LocMem)")
+                self._warned_local_cache = True
+            return False
+
+        if cache.add(self.key, self.token, timeout=self.ttl):
+            logger.info(f"👑 Became {self.name} leader")
+        elif not self.renew():
+            return False
+
+        if self._heartbeat is None or not self._heartbeat.is_alive():
+            self._stop = threading.Event()
+            self._heartbeat = threading.Thread(target=self._keep_alive, args=(self._stop,), daemon=True)
+            self._heartbeat.start()
+        return True
+
+    def _holds_advisory_lock(self):
+        # The lock is gone if Django has reconnected since we took it
+        return self._held_on is not None and self._held_on is connection.connection and not self._held_on.closed
+
+    def _acquire_advisory_lock(self):
+        connection.ensure_connection()
+        if self._holds_advisory_lock():
+            return True
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.lock_id])
+            acquired = cursor.fetchone()[0]
+        if acquired:
+            self._held_on = connection.connection
+            logger.info(f"👑 Became {self.name} leader (advisory lock {self.lock_id})")
+        return acquired
+
+    def renew(self):
+        with cache_lock(f"{self.key}:lock") as locked:
+            if not locked or cache.get(self.key) != self.token:
+                return False
+            cache.set(self.key, self.token, timeout=self.ttl)
+            return True
+
+    def _keep_alive(self, stop):
+        while not stop.wait(max(1, self.ttl / 3)):
+            if not self.renew():
+                logger.warning(f"⚠️ Lost {self.name} leadership")
+                return
+
+    @property
+    def is_leader(self):
+        if self._use_advisory_lock():
+            return self._holds_advisory_lock()
+        return cache.get(self.key) == self.token
+
+    def release(self):
+        if self._use_advisory_lock():
+            if self._holds_advisory_lock():
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", [self.lock_id])
+                logger.info(f"👋 Gave up {self.name} leadership")
+            self._held_on = None
+            return
+
+        self._stop.set()
+        with cache_lock(f"{self.key}:lock") as locked:
+            if locked and cache.get(self.key) == self.token:
+                cache.delete(self.key)
+                logger.info(f"👋 Gave up {self.name} leadership")
+
+
+def priority_for_user(user):
+    if user is not None and user.is_authenticated:
+        return PRIORITY_AUTHENTICATED
+    return PRIORITY_ANONYMOUS
+
+
+face_swap_limit = AdaptiveLimit('face-swap')
+face_swap_semaphore = DistributedSemaphore('face-swap', limit=face_swap_limit)
+
+
+def swap_with_feedback(client, source, target):
+    """Run client.swap_faces and feed its latency/outcome into the adaptive limit"""
+    started = time.monotonic()
+    try:
+        result = client.swap_faces(source, target)
+    except Exception as e:
+        face_swap_limit.record(time.monotonic() - started, classify_swap_error(e))
+        raise
+    face_swap_limit.record(time.monotonic() - started, OUTCOME_SUCCESS)
+    return result
@@ -0,0 +1,73 @@
+# imagegen/expiry.py - Event-driven cleanup of expired images, bucketed by hour
+
+import time
+import logging
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import cache
+from .models import GeneratedImage
+from .cloudinary_cleanup import cleanup_expired_images
+
+logger = logging.getLogger(__name__)
+
+# Expiry times are rounded up to the end of a bucket this long; one task per bucket
+BUCKET_SECONDS = getattr(settings, 'IMAGEGEN_EXPIRY_BUCKET_SECONDS', 60 * 60)
+# Off: rely on the periodic scan alone
+SCHEDULING_ENABLED = getattr(settings, 'IMAGEGEN_EXPIRY_SCHEDULING', True)
+# Longest ETA handed to the broker. Redis redelivers unacked messages after its
+# visibility timeout (1 hour by default), so a bucket days away is reached in hops.
+MAX_ETA_SECONDS = getattr(settings, 'IMAGEGEN_EXPIRY_MAX_ETA', 45 * 60)
+# After a failed enqueue (broker down) the bucket isn't retried for this long, so the
+# request path pays for a blocking apply_async at most once per bucket per interval
+SCHEDULE_RETRY_SECONDS = getattr(settings, 'IMAGEGEN_EXPIRY_SCHEDULE_RETRY', 5 * 60)
+
+
+def bucket_for(expires_at):
+    """Unix timestamp of the end of the bucket containing expires_at"""
+    return (int(expires_at.timestamp() // BUCKET_SECONDS) + 1) * BUCKET_SECONDS
+
+
+def enqueue_bucket(bucket):
+    """Enqueue the bucket's task for when it closes, or for the next hop towards it"""
+    from .tasks import expire_bucket_task
+
+    eta = min(bucket, time.time() + MAX_ETA_SECONDS)
+    expire_bucket_task.apply_async(args=[bucket], eta=datetime.fromtimestamp(eta, tz=dt_timezone.utc))
+
+
+def schedule_expiry(expires_at):
+    """
+    Make sure a Celery task is due when expires_at's bucket closes. The first
+    image in a bucket enqueues it (cache.add dedupes), the rest are free.
+    If enqueueing fails the bucket backs off for SCHEDULE_RETRY_SECONDS; the
+    periodic scan still finds its images.
+    """
+    if not SCHEDULING_ENABLED:
+        return
+
+    bucket = bucket_for(expires_at)
+    key = f"expiry-bucket:{bucket}"
+    if not cache.add(key, True, timeout=max(60, int(bucket - time.time()) + BUCKET_SECONDS)):
+        return
+
+    try:
+        enqueue_bucket(bucket)
+        logger.debug(f"⏰ Scheduled expiry bucket {bucket}")
+    except Exception as e:
+        cache.set(key, True, timeout=SCHEDULE_RETRY_SECONDS)
+        logger.warning(f"⚠️ Could not schedule expiry bucket {bucket}, retrying in {SCHEDULE_RETRY_SECONDS}s "
+                       f"(the periodic scan covers it meanwhile): {e}")
+
+
+def process_bucket(bucket):
+    """
+    Clean up everything that expired before the bucket closed. Earlier
+    stragglers come along too; a duplicate delivery finds nothing left.
+    """
+    cutoff = datetime.fromtimestamp(bucket, tz=dt_timezone.utc)
+    due = GeneratedImage.objects.due_for_cleanup(cutoff)
+    if not due.exists():
+        return 0, 0
+    cleaned, failed = cleanup_expired_images(due)
+    logger.info(f"⏰ Expiry bucket {cutoff:%Y-%m-%d %H:%M}: {cleaned} cleaned, {failed} failed")
+    return cleaned, failed
@@ -5,16 +5,21 @@ from pathlib import Path
 
 EMBEDDINGS_PATH = Path(__file__).resolve().parent.parent / "face_data" / "embeddings.json"
 
-def match_face(uploaded_image_path):
+def match_face(uploaded_image):
     """
     Match an uploaded face image against historical figures
+    `uploaded_image` is a path, a readable binary file object or an
+    already decoded RGB array (e.g. PreparedImage.array)
     Returns best match with confidence score
     """
     try:
-        print(f"🔍 Processing uploaded image: {uploaded_image_path}")
-        
-        # Load the uploaded selfie
-        image = face_recognition.load_image_file(uploaded_image_path)
+        if isinstance(uploaded_image, np.ndarray):
+            print(f"🔍 Processing decoded image: {uploaded_image.shape[1]}x{uploaded_image.shape[0]}")
+            image = uploaded_image
+        else:
+            print(f"🔍 Processing uploaded image: {getattr(uploaded_image, 'name', uploaded_image)}")
+            # Load the uploaded selfie
+            image = face_recognition.load_image_file(uploaded_image)
         face_locations = face_recognition.face_locations(image)
         
         if not face_locations:
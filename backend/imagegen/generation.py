@@ -0,0 +1,555 @@
+# imagegen/generation.py - Staged face generation shared by the views and Celery
+
+import os
+import time
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from faceswap.huggingface_utils import FaceFusionClient
+from .models import GeneratedImage
+from .quota import get_quota_backend
+from .expiry import schedule_expiry
+from .face_match import match_face
+from .quality import check_selfie
+from .utils import PreparedImage, EncodedImage, SelfieBuffer, encode_result, IMAGE_FORMATS
+from .data.historical_figures import HISTORICAL_FIGURES
+from .progress import publish, image_channel
+from .concurrency import face_swap_semaphore, swap_with_feedback, priority_for_user, AdmissionRejected
+from .pipeline import Pipeline, PipelineContext, Stage
+
+logger = logging.getLogger(__name__)
+
+MODE_MATCH = 'match'
+MODE_RANDOMIZE = 'randomize'
+
+# Deferred persistence: the request path writes the GeneratedImage row once,
+# after the swap, instead of creating it up front and updating it as it goes
+DEFER_PERSISTENCE = getattr(settings, 'IMAGEGEN_DEFER_PERSISTENCE', True)
+# Randomize skips face matching, so it gets a cheap local check before uploading and swapping
+SELFIE_GATE_ENABLED = getattr(settings, 'SELFIE_GATE_ENABLED', True)
+
+
+class GenerationError(Exception):
+    """A user-facing failure (bad input, no match) carrying the response payload"""
+
+    def __init__(self, payload, status_code=400):
+        super().__init__(payload.get("error", "Generation failed"))
+        self.payload = payload
+        self.status_code = status_code
+
+
+class RemoteImage:
+    """Minimal stand-in for an ImageField that only exposes a URL"""
+    def __init__(self, url):
+        self.url = url
+
+
+def wants_async(request):
+    """True when the client asked for job mode (?async=1 or an `async` form field)"""
+    value = request.query_params.get('async') or request.data.get('async')
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def owner_fields(ctx):
+    """The signed-in user, else the anonymous quota client; status views check one or the other"""
+    user = ctx.get('user')
+    if user is not None and user.is_authenticated:
+        return {'user': user}
+    return {'user': None, 'owner_client': ctx.get('quota_client') or ""}
+
+
+def prompt_for(mode, match_name):
+    if not match_name:
+        return ""
+    if mode == MODE_RANDOMIZE:
+        return f"You as {match_name} (randomized)"
+    return f"You as {match_name}"
+
+
+# Stages
+
+def stage_admit(ctx):
+    """Wait for a face swap slot. stage_swap frees it; the cleanup covers pipelines that fail first"""
+    image = ctx.get('image')
+
+    def report_position(position, eta_seconds):
+        if image is not None:
+            publish(image_channel(image.id), 'queued',
+                    queue_position=position + 1, eta_seconds=round(eta_seconds))
+
+    lease = face_swap_semaphore.acquire(
+        priority=ctx['priority'],
+        max_wait=ctx.get('max_wait'),
+        on_wait=report_position,
+        should_stop=lambda: ctx.cancelled,
+    )
+    ctx.add_cleanup(lease.release)
+    return {'lease': lease}
+
+
+def stage_compress(ctx):
+    """
+    Decode the upload once. Matching reads the decoded array and hashing and
+    the upload read the one compressed buffer, so nothing is decoded twice.
+    """
+    selfie = ctx['selfie_file']
+    try:
+        selfie_image = PreparedImage(selfie)
+    except Exception as e:
+        raise GenerationError({"error": f"Could not read the uploaded image: {e}"}, status_code=400)
+
+    encoded = selfie_image.encoded
+    return {
+        'selfie_image': selfie_image,
+        'selfie_buffer': encoded.buffer,
+        'selfie_sha256': encoded.buffer.sha256(),
+        'selfie_format': encoded.format,
+        'selfie_name': f"compressed_{os.path.splitext(selfie.name)[0]}{encoded.extension}",
+    }
+
+
+def stage_load_selfie(ctx):
+    """Job mode: the selfie was stored at enqueue time, read it back"""
+    with ctx['image'].selfie.open('rb') as selfie_file:
+        return {'selfie_image': PreparedImage(selfie_file)}
+
+
+def stage_match(ctx):
+    # Detection runs on the already decoded pixels
+    match_result = match_face(ctx['selfie_image'].array)
+
+    if "error" in match_result:
+        raise GenerationError(match_result, status_code=400)
+
+    return {
+        'match_name': match_result["match_name"],
+        'match_score': match_result.get("score", 0),
+    }
+
+
+def stage_quality_gate(ctx):
+    """Randomize: reject selfies without a usable face before any remote work"""
+    problem = check_selfie(ctx['selfie_image'].image)
+    if problem:
+        raise GenerationError(problem, status_code=400)
+    return {'selfie_checked': True}
+
+
+def selfie_stages(mode):
+    """Quality gate (randomize only) and selfie upload, shared by the request and enqueue pipelines"""
+    upload_requires = ['selfie_buffer', 'selfie_name']
+    stages = []
+    if mode == MODE_RANDOMIZE and SELFIE_GATE_ENABLED:
+        stages.append(Stage('quality_gate', stage_quality_gate, requires=['selfie_image'],
+                            provides=['selfie_checked']))
+        upload_requires.append('selfie_checked')
+    stages.append(Stage('upload_selfie', stage_upload_selfie, requires=upload_requires,
+                        provides=['selfie_path'], retries=1, rollback=rollback_upload_selfie))
+    return stages
+
+
+def stage_figure(ctx):
+    match_name = ctx['match_name']
+    historical_image_url = ctx.get('historical_image_url') or HISTORICAL_FIGURES.get(match_name)
+    if not historical_image_url:
+        raise GenerationError({"error": f"No historical image available for {match_name}"}, status_code=400)
+    return {'historical_image_url': historical_image_url}
+
+
+def buffer_file(buffer, field_name, name, format_name):
+    """Wrap a SelfieBuffer as an uploaded file without copying it"""
+    return InMemoryUploadedFile(
+        file=buffer.open(),
+        field_name=field_name,
+        name=name,
+        content_type=IMAGE_FORMATS[format_name][2],
+        size=buffer.size,
+        charset=None,
+    )
+
+
+def stage_upload_selfie(ctx):
+    """
+    Upload the selfie straight to the selfie field's storage. It only needs the
+    compressed bytes, so it runs while the face is being matched.
+    """
+    selfie_field = GeneratedImage._meta.get_field('selfie')
+    upload = buffer_file(ctx['selfie_buffer'], 'selfie', ctx['selfie_name'], ctx['selfie_format'])
+    name = selfie_field.generate_filename(None, ctx['selfie_name'])
+    stored_name = selfie_field.storage.save(name, upload)
+    return {'selfie_path': stored_name}
+
+
+def rollback_upload_selfie(ctx):
+    GeneratedImage._meta.get_field('selfie').storage.delete(ctx['selfie_path'])
+
+
+def stage_store_selfie(ctx):
+    """Create the GeneratedImage row pointing at the already uploaded selfie"""
+    match_name = ctx.get('match_name') or ""
+    image = GeneratedImage(
+        **owner_fields(ctx),
+        prompt=prompt_for(ctx['mode'], match_name),
+        match_name=match_name,
+        selfie=ctx['selfie_path'],
+        selfie_format=ctx['selfie_format'],
+        status=ctx.get('initial_status', 'processing'),
+    )
+    image.refresh_storage_refs()
+    image.save()
+    transaction.on_commit(lambda: schedule_expiry(image.expires_at))
+    return {'image': image}
+
+
+def rollback_store_selfie(ctx):
+    ctx['image'].delete()
+
+
+def stage_mark_processing(ctx):
+    """Job mode: the slot is ours, flip the row from queued to processing"""
+    image = ctx['image']
+    image.status = 'processing'
+    image.save(update_fields=['status'])
+    publish(image_channel(image.id), 'processing')
+    return {'processing': True}
+
+
+def stage_record_match(ctx):
+    """Job mode: persist the match on the already stored row"""
+    image = ctx['image']
+    image.match_name = ctx['match_name']
+    image.prompt = prompt_for(ctx['mode'], image.match_name)
+    image.save(update_fields=['match_name', 'prompt'])
+    return {'match_recorded': True}
+
+
+def stage_swap(ctx):
+    ctx.check_cancelled()
+    if 'image' in ctx:
+        selfie_url = ctx['image'].selfie_delivery_url
+    else:
+        selfie_url = GeneratedImage._meta.get_field('selfie').storage.url(ctx['selfie_path'])
+
+    client = FaceFusionClient()
+    lease = ctx['lease']
+    started = time.monotonic()
+    try:
+        result_image_data = swap_with_feedback(
+            client,
+            RemoteImage(selfie_url),
+            RemoteImage(ctx['historical_image_url']),
+        )
+    except Exception:
+        lease.release()
+        raise
+    # The slot only guards the swap: free it before encoding and saving, and
+    # time the swap alone for queue ETAs
+    lease.release(duration=time.monotonic() - started)
+    return {'result_image_data': result_image_data}
+
+
+def stage_encode_result(ctx):
+    """Re-encode the swap result into the configured format and byte budget"""
+    result_image_data = ctx['result_image_data']
+    try:
+        result = encode_result(result_image_data)
+    except Exception as e:
+        # Unreadable by Pillow - store the bytes exactly as the swap returned them
+        logger.warning(f"⚠️ Could not re-encode swap result, storing it as is: {e}")
+        result = EncodedImage(SelfieBuffer(result_image_data), 'jpeg', None, '.jpg', 'image/jpeg')
+    logger.info(f"🗜️ Swap result {len(result_image_data)} -> {result.buffer.size} bytes "
+                f"({result.format}, quality {result.quality})")
+    return {'result': result}
+
+
+def output_name(ctx, prefix):
+    suffix = 'fused' if ctx['mode'] == MODE_MATCH else 'randomized'
+    return f"{prefix}_{suffix}_{ctx['match_name'].replace(' ', '_')}{ctx['result'].extension}"
+
+
+def stage_save(ctx):
+    image = ctx['image']
+    result = ctx['result']
+    name = output_name(ctx, image.id)
+    image.output_image.save(name, buffer_file(result.buffer, 'output_image', name, result.format), save=False)
+    image.output_format = result.format
+    image.status = 'completed'
+    image.save(update_fields=['output_image', 'output_format', 'status', *image.refresh_storage_refs()])
+    return {'saved': True}
+
+
+def stage_upload_output(ctx):
+    """Deferred mode: store the swap result before the row exists (named by selfie hash)"""
+    result = ctx['result']
+    output_field = GeneratedImage._meta.get_field('output_image')
+    name = output_field.generate_filename(None, output_name(ctx, ctx['selfie_sha256'][:16]))
+    stored_name = output_field.storage.save(
+        name, buffer_file(result.buffer, 'output_image', os.path.basename(name), result.format)
+    )
+    return {'output_path': stored_name}
+
+
+def rollback_upload_output(ctx):
+    GeneratedImage._meta.get_field('output_image').storage.delete(ctx['output_path'])
+
+
+def stage_persist(ctx):
+    """
+    Deferred mode: one INSERT carrying both image references, in a single
+    transaction. Nothing is written for failed requests.
+    """
+    match_name = ctx['match_name']
+    with transaction.atomic():
+        image = GeneratedImage(
+            **owner_fields(ctx),
+            prompt=prompt_for(ctx['mode'], match_name),
+            match_name=match_name,
+            selfie=ctx['selfie_path'],
+            selfie_format=ctx['selfie_format'],
+            output_image=ctx['output_path'],
+            output_format=ctx['result'].format,
+            status='completed',
+        )
+        image.refresh_storage_refs()
+        image.save()
+        transaction.on_commit(lambda: schedule_expiry(image.expires_at))
+    return {'image': image, 'saved': True}
+
+
+# Progress events derived from stage transitions
+STAGE_EVENTS = {
+    ('completed', 'match'): 'matched',
+    ('completed', 'store_selfie'): 'uploaded',
+    ('started', 'swap'): 'swapping',
+    ('completed', 'save'): 'saved',
+}
+
+
+def publish_stage_event(event, stage, ctx):
+    progress_event = STAGE_EVENTS.get((event, stage.name))
+    image = ctx.get('image')
+    if not progress_event or image is None:
+        return
+
+    data = {}
+    if progress_event == 'matched':
+        data = {"match_name": ctx['match_name'], "match_score": round(float(ctx.get('match_score', 0)), 3)}
+    elif progress_event == 'uploaded':
+        data = {"original_selfie_url": image.selfie_delivery_url}
+    publish(image_channel(image.id), progress_event, **data)
+
+
+def build_pipeline(mode, job=False, deferred=None):
+    """
+    Stages for one generation.
+
+    Request (job=False): compress -> {match -> figure | upload_selfie} -> store_selfie -> admit -> swap -> save
+    Deferred request: compress -> {match -> figure | upload_selfie} -> admit -> swap -> upload_output -> persist
+    Job (job=True): the row exists already, so [load_selfie -> match -> record_match] -> figure -> admit -> swap -> ...
+    Matching is CPU-bound and the selfie upload is network-bound, so they
+    overlap; if matching fails the uploaded selfie is deleted again.
+    Admission to a face swap slot waits until everything the swap needs is
+    ready, so the slot is held for the swap call alone.
+    """
+    if job:
+        admit_requires = ['historical_image_url']
+        stages = [Stage('mark_processing', stage_mark_processing,
+                        requires=['image', 'lease'], provides=['processing'])]
+        swap_requires = ['image', 'historical_image_url', 'lease', 'processing']
+        if mode == MODE_MATCH:
+            stages += [
+                Stage('load_selfie', stage_load_selfie, requires=['image'],
+                      provides=['selfie_image'], retries=2),
+                Stage('match', stage_match, requires=['selfie_image'],
+                      provides=['match_name', 'match_score']),
+                Stage('record_match', stage_record_match, requires=['match_name'],
+                      provides=['match_recorded']),
+            ]
+            admit_requires.append('match_recorded')
+            swap_requires.append('match_recorded')
+        stages.append(Stage('figure', stage_figure, requires=['match_name'],
+                            provides=['historical_image_url']))
+        stages.append(Stage('admit', stage_admit, requires=admit_requires, provides=['lease']))
+    else:
+        stages = [Stage('compress', stage_compress, requires=['selfie_file'],
+                        provides=['selfie_image', 'selfie_buffer', 'selfie_sha256',
+                                  'selfie_format', 'selfie_name'])]
+        if mode == MODE_MATCH:
+            stages.append(Stage('match', stage_match, requires=['selfie_image'],
+                                provides=['match_name', 'match_score']))
+        stages += selfie_stages(mode)
+        stages.append(Stage('figure', stage_figure, requires=['match_name'],
+                            provides=['historical_image_url']))
+
+        if DEFER_PERSISTENCE if deferred is None else deferred:
+            stages += [
+                Stage('admit', stage_admit, requires=['selfie_path', 'historical_image_url'],
+                      provides=['lease']),
+                Stage('swap', stage_swap, requires=['selfie_path', 'historical_image_url', 'lease'],
+                      provides=['result_image_data']),
+                Stage('encode_result', stage_encode_result, requires=['result_image_data'],
+                      provides=['result']),
+                Stage('upload_output', stage_upload_output, requires=['result'],
+                      provides=['output_path'], retries=1, rollback=rollback_upload_output),
+                Stage('persist', stage_persist, requires=['output_path', 'selfie_path'],
+                      provides=['image', 'saved']),
+            ]
+            return generation_pipeline(mode, stages)
+
+        stages += [
+            Stage('store_selfie', stage_store_selfie,
+                  requires=['selfie_path', 'historical_image_url'],
+                  provides=['image'], rollback=rollback_store_selfie),
+            # After store_selfie, so the queue position is published on the row's channel
+            Stage('admit', stage_admit, requires=['image'], provides=['lease']),
+        ]
+        swap_requires = ['image', 'historical_image_url', 'lease']
+
+    stages += [
+        Stage('swap', stage_swap, requires=swap_requires, provides=['result_image_data']),
+        Stage('encode_result', stage_encode_result, requires=['result_image_data'], provides=['result']),
+        Stage('save', stage_save, requires=['result'], provides=['saved'], retries=1),
+    ]
+    return generation_pipeline(mode, stages)
+
+
+def generation_pipeline(mode, stages):
+    # match and upload_selfie run side by side
+    return Pipeline(f"generate-{mode}", stages, max_workers=3, on_event=publish_stage_event)
+
+
+def build_enqueue_pipeline(mode):
+    return Pipeline(f"enqueue-{mode}", [
+        Stage('compress', stage_compress, requires=['selfie_file'],
+              provides=['selfie_image', 'selfie_buffer', 'selfie_sha256', 'selfie_format',
+                        'selfie_name']),
+        *selfie_stages(mode),
+        Stage('store_selfie', stage_store_selfie, requires=['selfie_path'], provides=['image']),
+    ], on_event=publish_stage_event)
+
+
+# Entry points
+
+def generate_now(selfie_file, mode, user=None, match_name=None, historical_image_url=None, quota_client=None):
+    """
+    Run the whole pipeline inside the request. Returns the finished context
+    (image, match_name, match_score, historical_image_url, timings).
+    Raises GenerationError, AdmissionRejected or the failing stage's exception.
+    Usage quota is reserved (and refunded on failure) by UsageLimitMiddleware;
+    `quota_client` also records which anonymous caller owns the image.
+    """
+    ctx = PipelineContext(
+        selfie_file=selfie_file,
+        mode=mode,
+        user=user,
+        quota_client=quota_client,
+        priority=priority_for_user(user),
+    )
+    if mode == MODE_RANDOMIZE:
+        ctx.update({'match_name': match_name, 'match_score': 1.0, 'historical_image_url': historical_image_url})
+
+    return build_pipeline(mode).run(ctx)
+
+
+def enqueue_generation(selfie_file, mode, user=None, quota_client=None, match_name=""):
+    """
+    Store the selfie on a queued GeneratedImage and hand it to Celery.
+    Raises GenerationError (503) if the job can't be queued; nothing is kept then.
+    """
+    from .tasks import process_generation_task
+
+    ctx = PipelineContext(
+        selfie_file=selfie_file,
+        mode=mode,
+        user=user,
+        quota_client=quota_client,
+        match_name=match_name,
+        initial_status='queued',
+    )
+    image = build_enqueue_pipeline(mode).run(ctx)['image']
+
+    # The job refunds the anonymous quota reserved for this request if it fails
+    if user is not None and user.is_authenticated:
+        quota_client = None
+
+    try:
+        process_generation_task.delay(image.id, mode, quota_client)
+    except Exception as e:
+        # Nothing would ever run the job: drop the row and its stored selfie
+        logger.error(f"❌ Could not queue generation job {image.id}: {e}")
+        try:
+            image.selfie.storage.delete(image.selfie.name)
+        except Exception as delete_error:
+            logger.warning(f"⚠️ Could not delete selfie of unqueued job {image.id}: {delete_error}")
+        image.delete()
+        raise GenerationError({"error": "Could not queue your transformation. Please try again."},
+                              status_code=503)
+
+    logger.info(f"📥 Queued generation job {image.id} ({mode})")
+    return image
+
+
+def fail_generation_job(image_id, message, mode=None, quota_client=None):
+    """Mark a job failed without running it (e.g. it never got a face swap slot)"""
+    failed = GeneratedImage.objects.filter(id=image_id).exclude(status__in=['completed', 'failed']).update(
+        status='failed', error_message=message
+    )
+    if failed and quota_client:
+        get_quota_backend().refund(quota_client, mode)
+    publish(image_channel(image_id), 'failed', error=message)
+
+
+def run_generation_job(image_id, mode, quota_client=None, max_wait=None, priority=None):
+    """
+    Process a queued GeneratedImage through the same pipeline as the views.
+    Status transitions are persisted so ImageStatusView reports real state.
+    Raises AdmissionRejected (job stays queued) when no face swap slot frees up.
+    `priority` overrides the traffic class derived from the owner (e.g. batch jobs).
+    The anonymous quota reserved at request time is refunded if the job fails.
+    """
+    try:
+        image = GeneratedImage.objects.select_related('user').get(id=image_id)
+    except GeneratedImage.DoesNotExist:
+        logger.error(f"❌ Generation job {image_id} not found")
+        return False
+
+    if image.status in ('completed', 'failed'):
+        logger.info(f"ℹ️ Generation job {image_id} already {image.status}")
+        return image.status == 'completed'
+
+    ctx = PipelineContext(
+        image=image,
+        mode=mode,
+        user=image.user,
+        priority=priority or priority_for_user(image.user),
+        max_wait=max_wait,
+    )
+    if mode == MODE_RANDOMIZE:
+        ctx.update({'match_name': image.match_name})
+
+    channel = image_channel(image.id)
+    try:
+        build_pipeline(mode, job=True).run(ctx)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Generation job {image_id} failed: {e}")
+        image.status = 'failed'
+        image.error_message = str(e)
+        image.save(update_fields=['status', 'error_message'])
+        if quota_client:
+            get_quota_backend().refund(quota_client, mode)
+        publish(channel, 'failed', error=str(e))
+        return False
+
+    publish(
+        channel, 'completed',
+        id=image.id,
+        match_name=image.match_name,
+        output_image_url=image.output_delivery_url,
+        original_selfie_url=image.selfie_delivery_url,
+        historical_figure_url=ctx['historical_image_url'],
+    )
+    logger.info(f"✅ Generation job {image_id} completed: {image.match_name}")
+    return True
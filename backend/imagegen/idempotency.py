@@ -0,0 +1,181 @@
+# imagegen/idempotency.py - Idempotency-Key support for expensive POST endpoints
+
+import time
+import hashlib
+import logging
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+# Completed responses are replayed for this long
+IDEMPOTENCY_TTL = getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 60 * 60)
+# An in-flight marker outlives any real execution, so a crashed worker doesn't block the key forever
+IN_FLIGHT_TTL = getattr(settings, 'IDEMPOTENCY_IN_FLIGHT_TTL', 15 * 60)
+# How long a concurrent repeat waits for the original request to finish
+WAIT_SECONDS = getattr(settings, 'IDEMPOTENCY_WAIT_SECONDS', 120)
+POLL_INTERVAL = 0.5
+MAX_KEY_LENGTH = 255
+
+STATE_IN_FLIGHT = 'in_flight'
+STATE_DONE = 'done'
+
+
+def _caller(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    quota_client = getattr(request, 'quota_client', None)
+    if quota_client:
+        return f"client:{quota_client}"
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if session_key:
+        return f"session:{session_key}"
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def fingerprint(request):
+    """Hash of what makes two requests "the same": method, path, form fields and file contents"""
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.path}".encode())
+
+    for name in sorted(request.data.keys()):
+        if name in request.FILES:
+            continue
+        values = request.data.getlist(name) if hasattr(request.data, 'getlist') else [request.data[name]]
+        digest.update(f"\0{name}={values}".encode())
+
+    for name in sorted(request.FILES.keys()):
+        for upload in request.FILES.getlist(name):
+            digest.update(f"\0{name}:{upload.size}:".encode())
+            for chunk in upload.chunks():
+                digest.update(chunk)
+            upload.seek(0)
+
+    return digest.hexdigest()
+
+
+def _record_key(request, key):
+    scope = hashlib.sha256(f"{_caller(request)}|{request.path}|{key}".encode()).hexdigest()
+    return f"idempotency:{scope}"
+
+
+def has_idempotency_record(request):
+    """
+    Whether this request's Idempotency-Key already has a stored or in-flight
+    execution. Cheap and body-free, so UsageLimitMiddleware can call it
+    before the upload is parsed; @idempotent does the full fingerprint check.
+    """
+    key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return False
+    return cache.get(_record_key(request, key)) is not None
+
+
+def _replay(record):
+    response = Response(record['data'], status=record['status'])
+    for header, value in record.get('headers', {}).items():
+        response[header] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _wait_for_result(record_key):
+    """
+    Attach to an execution running elsewhere: poll until it stores its response.
+    Returns (record, still_running); record is None if it failed or didn't finish in time.
+    """
+    deadline = time.monotonic() + WAIT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        record = cache.get(record_key)
+        if record is None:
+            # The original failed without a storable response
+            return None, False
+        if record['state'] == STATE_DONE:
+            return record, False
+    return None, True
+
+
+def idempotent(view_method):
+    """
+    Decorate an APIView handler so requests carrying an `Idempotency-Key` header
+    execute at most once per key:
+
+    - the first request runs and its response is stored for IDEMPOTENCY_TTL
+    - repeats get the stored response back (with `Idempotent-Replayed: true`)
+    - repeats arriving while the first is still running wait for its result
+    - reusing a key with a different body is rejected with 422
+
+    Server errors (5xx) are not stored, so a retry after one runs again.
+    Requests without the header are unaffected.
+    """
+    @wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key:
+            return view_method(view, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({"error": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters"}, status=400)
+
+        record_key = _record_key(request, key)
+        request_fingerprint = fingerprint(request)
+        in_flight = {'state': STATE_IN_FLIGHT, 'fingerprint': request_fingerprint}
+
+        if not cache.add(record_key, in_flight, timeout=IN_FLIGHT_TTL):
+            record = cache.get(record_key)
+            if record is not None:
+                if record['fingerprint'] != request_fingerprint:
+                    return Response({
+                        "error": "Idempotency-Key was already used with a different request",
+                    }, status=422)
+                if record['state'] == STATE_DONE:
+                    logger.info(f"🔁 Replaying stored response for idempotency key {key}")
+                    return _replay(record)
+
+                logger.info(f"⏳ Idempotency key {key} is in flight, waiting for its result")
+                record, still_running = _wait_for_result(record_key)
+                if record is not None:
+                    return _replay(record)
+                if still_running:
+                    error = "A request with this Idempotency-Key is still being processed"
+                else:
+                    error = "The original request with this Idempotency-Key failed; retry it"
+                response = Response({"error": error}, status=409)
+                response['Retry-After'] = '5' if still_running else '1'
+                return response
+
+            # Expired between add() and get(); claim it now
+            if not cache.add(record_key, in_flight, timeout=IN_FLIGHT_TTL):
+                return Response({"error": "Concurrent request with this Idempotency-Key"}, status=409)
+
+        # The middleware skipped the quota for what looked like a repeat; this one executes
+        from .middleware import reserve_usage
+        limit_response = reserve_usage(request)
+        if limit_response is not None:
+            cache.delete(record_key)
+            return limit_response
+
+        try:
+            response = view_method(view, request, *args, **kwargs)
+        except Exception:
+            cache.delete(record_key)
+            raise
+
+        if response.status_code >= 500 or not hasattr(response, 'data'):
+            cache.delete(record_key)
+            return response
+
+        headers = {name: response[name] for name in ('Retry-After', 'Location') if response.has_header(name)}
+        cache.set(record_key, {
+            'state': STATE_DONE,
+            'fingerprint': request_fingerprint,
+            'status': response.status_code,
+            'data': response.data,
+            'headers': headers,
+        }, timeout=IDEMPOTENCY_TTL)
+        return response
+
+    return wrapper
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from imagegen.models import GeneratedImage
+
+REF_FIELDS = ['selfie_public_id', 'selfie_url', 'output_public_id', 'output_url']
+
+
+class Command(BaseCommand):
+    help = 'Fill the stored Cloudinary public_id/URL columns of images written before they existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Rows written per bulk update',
+        )
+        parser.add_argument(
+            '--test',
+            action='store_true',
+            help='Test mode - show how many rows would be updated without writing',
+        )
+
+    def handle(self, *args, **options):
+        missing = (
+            GeneratedImage.objects
+            .filter(is_expired=False)
+            .filter(
+                Q(selfie_public_id="") & ~Q(selfie="")
+                | Q(output_public_id="") & Q(output_image__isnull=False) & ~Q(output_image="")
+            )
+            .order_by('id')
+        )
+        total = missing.count()
+        self.stdout.write(f"📊 {total} images missing stored public_ids/URLs")
+        if options['test'] or total == 0:
+            return
+
+        batch = []
+        updated = 0
+        for image in missing.iterator(chunk_size=options['batch_size']):
+            image.refresh_storage_refs()
+            batch.append(image)
+            if len(batch) >= options['batch_size']:
+                updated += GeneratedImage.objects.bulk_update(batch, REF_FIELDS)
+                self.stdout.write(f"  ✅ {updated}/{total}")
+                batch = []
+        if batch:
+            updated += GeneratedImage.objects.bulk_update(batch, REF_FIELDS)
+
+        self.stdout.write(self.style.SUCCESS(f'🎉 Backfilled {updated} images'))
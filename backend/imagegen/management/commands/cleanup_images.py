@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from imagegen.models import GeneratedImage
+from imagegen.cloudinary_cleanup import cleanup_expired_images
 import logging
 
 logger = logging.getLogger(__name__)
@@ -24,8 +25,18 @@ class Command(BaseCommand):
             type=int,
             help='Clean up specific image by ID',
         )
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            help='Print the database query plan for the expired-image scan and exit',
+        )
 
     def handle(self, *args, **options):
+        if options['explain']:
+            # Should show an index scan on cleanup_due_idx, not a sequential scan
+            self.stdout.write(GeneratedImage.objects.due_for_cleanup().explain())
+            return
+
         self.stdout.write(
             self.style.SUCCESS('🧹 Starting image cleanup...')
         )
@@ -39,10 +50,10 @@ class Command(BaseCommand):
                 if options['test']:
                     self.stdout.write(f"TEST MODE: Would delete image {image.id}")
                     if image.selfie:
-                        public_id = image.get_image_public_id(image.selfie)
+                        public_id = image.selfie_public_id or image.get_image_public_id(image.selfie)
                         self.stdout.write(f"  - Selfie public_id: {public_id}")
                     if image.output_image:
-                        public_id = image.get_image_public_id(image.output_image)
+                        public_id = image.output_public_id or image.get_image_public_id(image.output_image)
                         self.stdout.write(f"  - Output public_id: {public_id}")
                 else:
                     deleted_files = image.expire_and_cleanup()
@@ -67,11 +78,7 @@ class Command(BaseCommand):
             self.stdout.write(f"🔥 FORCE MODE: Cleaning up ALL {images_to_cleanup.count()} images")
         else:
             # Normal cleanup - only expired images
-            images_to_cleanup = GeneratedImage.objects.filter(
-                expires_at__lt=now,
-                is_expired=False,
-                cleanup_attempted=False
-            )
+            images_to_cleanup = GeneratedImage.objects.due_for_cleanup(now)
             self.stdout.write(f"📅 Normal cleanup: {images_to_cleanup.count()} expired images")
 
         if not images_to_cleanup.exists():
@@ -102,21 +109,9 @@ class Command(BaseCommand):
                 self.stdout.write('❌ Cleanup cancelled')
                 return
 
-        # Perform cleanup
-        deleted_count = 0
-        failed_count = 0
-
-        for img in images_to_cleanup:
-            try:
-                self.stdout.write(f"🧹 Cleaning up image {img.id}...")
-                deleted_files = img.expire_and_cleanup()
-                deleted_count += 1
-                self.stdout.write(f"  ✅ Success: {deleted_files}")
-            except Exception as e:
-                failed_count += 1
-                self.stdout.write(
-                    self.style.ERROR(f"  ❌ Failed: {e}")
-                )
+        # Perform cleanup - files are deleted in bulk, 100 per Admin API call
+        self.stdout.write(f"🧹 Cleaning up {images_to_cleanup.count()} images...")
+        deleted_count, failed_count = cleanup_expired_images(images_to_cleanup)
 
         # Summary
         self.stdout.write(
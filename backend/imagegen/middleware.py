@@ -1,10 +1,37 @@
 from django.http import JsonResponse
 from django.urls import resolve
-from .models import UsageSession
+from django.utils.functional import SimpleLazyObject
+from .quota import get_quota_backend
+from .idempotency import has_idempotency_record
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+def release_usage_reservation(request):
+    """Refund the quota unit the middleware reserved for this request, at most once"""
+    reservation = getattr(request, 'usage_reservation', None)
+    if reservation:
+        feature_type, client_id = reservation
+        get_quota_backend().refund(client_id, feature_type)
+        request.usage_reservation = None
+        logger.debug(f"↩️ Refunded {feature_type} quota")
+
+
+def reserve_usage(request):
+    """
+    Take the quota the middleware deferred for an idempotent repeat, once the
+    view is actually going to execute. Returns a 429 response if exhausted.
+    """
+    request = getattr(request, '_request', request)
+    deferred = getattr(request, 'usage_deferred', None)
+    if not deferred:
+        return None
+    request.usage_deferred = None
+    feature_type, client_id = deferred
+    return UsageLimitMiddleware.reserve(request, get_quota_backend(), client_id, feature_type)
+
+
 class UsageLimitMiddleware:
     """Track and enforce usage limits for anonymous users"""
     
@@ -36,38 +63,47 @@ class UsageLimitMiddleware:
             return self.get_response(request)
             
         logger.debug(f"🎯 Processing tracked endpoint: {endpoint_name}")
-        
-        # 🔥 CRITICAL FIX: Ensure session exists BEFORE checking usage
-        if not request.session.session_key:
-            request.session.create()
-            logger.debug(f"🔑 Created new session: {request.session.session_key}")
-        else:
-            logger.debug(f"🔑 Using existing session: {request.session.session_key}")
-            
-        # FORCE session save to ensure it persists
-        request.session.save()
-        
-        # Get or create usage session
-        usage_session = UsageSession.get_or_create_for_session(request.session.session_key)
-        logger.debug(f"📊 Usage session: matches={usage_session.matches_used}/{usage_session.MAX_MATCHES}, randomizes={usage_session.randomizes_used}/{usage_session.MAX_RANDOMIZES}")
-        
-        # Check limits BEFORE processing
+
+        # Session + UsageSession rows, or a signed token + cache counters (IMAGEGEN_QUOTA_BACKEND)
+        backend = get_quota_backend()
+        client_id = backend.client_id(request, create=True)
         feature_type = self.tracked_endpoints[endpoint_name]
-        
-        if feature_type == 'match' and not usage_session.can_match:
-            logger.debug("🚫 Match limit reached")
-            return self.create_limit_response('match', usage_session)
-        elif feature_type == 'randomize' and not usage_session.can_randomize:
-            logger.debug("🚫 Randomize limit reached")
-            return self.create_limit_response('randomize', usage_session)
-            
-        # Store usage session for view to use
-        request.usage_session = usage_session
-        logger.debug(f"✅ Request approved - feature: {feature_type}")
-        
-        return self.get_response(request)
+
+        request.quota_client = client_id
+
+        if has_idempotency_record(request):
+            # A retry of a request that already ran (or is running): @idempotent replays it
+            # without spending quota, and calls reserve_usage() only if it has to execute
+            logger.debug("🔁 Idempotent repeat - deferring quota check")
+            request.usage_deferred = (feature_type, client_id)
+        else:
+            # Reserve the quota up front in one atomic step; refunded below if the work fails
+            limit_response = self.reserve(request, backend, client_id, feature_type)
+            if limit_response:
+                return backend.finalize(request, limit_response)
+
+        response = self.get_response(request)
+
+        # Failed requests and idempotent replays of an earlier request don't spend quota
+        if response.status_code >= 400 or response.has_header('Idempotent-Replayed'):
+            release_usage_reservation(request)
+        return backend.finalize(request, response)
     
-    def create_limit_response(self, feature_type, usage_session):
+    @classmethod
+    def reserve(cls, request, backend, client_id, feature_type):
+        """Consume one unit; returns the 429 response if the limit is reached"""
+        if not backend.consume(client_id, feature_type):
+            logger.debug(f"🚫 {feature_type} limit reached")
+            return cls.create_limit_response(feature_type, backend.usage(client_id))
+
+        # Loaded only if the view needs it (usage data in the response)
+        request.usage_session = SimpleLazyObject(lambda: backend.usage(client_id))
+        request.usage_reservation = (feature_type, client_id)
+        logger.debug(f"✅ Request approved - feature: {feature_type}")
+        return None
+
+    @staticmethod
+    def create_limit_response(feature_type, usage_session):
         """Create response when user hits limit"""
         logger.info(f"🚫 Limit reached for {feature_type}")
         return JsonResponse({
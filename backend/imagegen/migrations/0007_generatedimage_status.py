@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagegen', '0006_alter_generatedimage_options'),
+    ]
+
+    operations = [
+        # Rows created before job mode were always written after a finished swap
+        migrations.AddField(
+            model_name='generatedimage',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='completed', max_length=20),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='generatedimage',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='queued', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='error_message',
+            field=models.TextField(blank=True),
+        ),
+    ]
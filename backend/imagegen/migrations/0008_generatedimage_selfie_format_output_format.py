@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagegen', '0007_generatedimage_status'),
+    ]
+
+    operations = [
+        # Everything stored before this was JPEG
+        migrations.AddField(
+            model_name='generatedimage',
+            name='selfie_format',
+            field=models.CharField(choices=[('jpeg', 'JPEG'), ('webp', 'WebP'), ('avif', 'AVIF')], default='jpeg', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='output_format',
+            field=models.CharField(choices=[('jpeg', 'JPEG'), ('webp', 'WebP'), ('avif', 'AVIF')], default='jpeg', max_length=10),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagegen', '0008_generatedimage_selfie_format_output_format'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=models.Index(condition=models.Q(('cleanup_attempted', False), ('is_expired', False)), fields=['expires_at'], name='cleanup_due_idx'),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagegen', '0010_generatedimage_user_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usagesession',
+            index=models.Index(fields=['created_at'], name='usage_created_idx'),
+        ),
+    ]
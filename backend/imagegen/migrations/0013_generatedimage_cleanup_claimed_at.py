@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagegen', '0012_generatedimage_storage_refs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generatedimage',
+            name='cleanup_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagegen', '0013_generatedimage_cleanup_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generatedimage',
+            name='owner_client',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
 from django.conf import settings
 from cloudinary_storage.storage import MediaCloudinaryStorage
 from django.utils import timezone
@@ -13,7 +14,34 @@ def get_expiration_time():
     """Get expiration time 48 hours from now"""
     return timezone.now() + timedelta(hours=48)
 
+
+class GeneratedImageQuerySet(models.QuerySet):
+    def due_for_cleanup(self, now=None):
+        """
+        Expired images whose Cloudinary files haven't been cleaned up yet.
+        Every cleanup path uses this so the query matches the partial index
+        (cleanup_due_idx) and walks it in expires_at order.
+        """
+        return self.filter(
+            expires_at__lt=now or timezone.now(),
+            is_expired=False,
+            cleanup_attempted=False,
+        ).order_by('expires_at')
+
+
 class GeneratedImage(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('processing', 'Processing'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    FORMAT_CHOICES = [
+        ('jpeg', 'JPEG'),
+        ('webp', 'WebP'),
+        ('avif', 'AVIF'),
+    ]
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.SET_NULL,
@@ -33,14 +61,36 @@ class GeneratedImage(models.Model):
         blank=True,
         storage=MediaCloudinaryStorage()
     )
-    output_url = models.URLField(blank=True, default="")
+    # Cloudinary public_ids and delivery URLs, written with the files so
+    # cleanup and listings never rebuild them from the storage backend
+    selfie_public_id = models.CharField(max_length=255, blank=True, default="")
+    selfie_url = models.URLField(max_length=500, blank=True, default="")
+    output_public_id = models.CharField(max_length=255, blank=True, default="")
+    output_url = models.URLField(max_length=500, blank=True, default="")
+    # Encoding the stored files were written in
+    selfie_format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='jpeg')
+    output_format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='jpeg')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    error_message = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(default=get_expiration_time)
+    # Anonymous images: the quota client id of the caller that created them
+    owner_client = models.CharField(max_length=64, blank=True, default="")
     is_expired = models.BooleanField(default=False)
     cleanup_attempted = models.BooleanField(default=False)
+    # Set while a cleaner works on the row, so concurrent cleaners skip it
+    cleanup_claimed_at = models.DateTimeField(null=True, blank=True)
+
+    objects = GeneratedImageQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.match_name} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
+
+    def is_owned_by(self, user, client_id=None):
+        """The signed-in owner (or staff), or for anonymous images the quota client that created it"""
+        if user is not None and user.is_authenticated and (user.is_staff or user.id == self.user_id):
+            return True
+        return self.user_id is None and bool(self.owner_client) and client_id == self.owner_client
     
     def extract_public_id_from_url(self, image_url):
         """
@@ -126,6 +176,36 @@ class GeneratedImage(models.Model):
             logger.error(f"❌ Error getting public_id: {e}")
             return None
     
+    def refresh_storage_refs(self):
+        """
+        Copy the public_id and delivery URL of each stored file into its
+        columns. Call after the file names are set, before saving.
+        Returns the names of the fields it set (for update_fields).
+        """
+        fields = []
+        if self.selfie:
+            self.selfie_public_id = self.get_image_public_id(self.selfie) or ""
+            self.selfie_url = self.selfie.url
+            fields += ['selfie_public_id', 'selfie_url']
+        if self.output_image:
+            self.output_public_id = self.get_image_public_id(self.output_image) or ""
+            self.output_url = self.output_image.url
+            fields += ['output_public_id', 'output_url']
+        return fields
+
+    @property
+    def selfie_delivery_url(self):
+        """Stored selfie URL, falling back to the storage backend for rows not yet backfilled"""
+        if self.selfie_url:
+            return self.selfie_url
+        return self.selfie.url if self.selfie else None
+
+    @property
+    def output_delivery_url(self):
+        if self.output_url:
+            return self.output_url
+        return self.output_image.url if self.output_image else None
+
     def delete_from_cloudinary(self):
         """Delete associated images from Cloudinary"""
         deleted_files = []
@@ -133,7 +213,7 @@ class GeneratedImage(models.Model):
         # Delete selfie
         if self.selfie:
             try:
-                public_id = self.get_image_public_id(self.selfie)
+                public_id = self.selfie_public_id or self.get_image_public_id(self.selfie)
                 if public_id:
                     result = cloudinary.uploader.destroy(public_id)
                     logger.info(f"🗑️ Cloudinary delete selfie result: {result}")
@@ -146,7 +226,7 @@ class GeneratedImage(models.Model):
         # Delete output image
         if self.output_image:
             try:
-                public_id = self.get_image_public_id(self.output_image)
+                public_id = self.output_public_id or self.get_image_public_id(self.output_image)
                 if public_id:
                     result = cloudinary.uploader.destroy(public_id)
                     logger.info(f"🗑️ Cloudinary delete output result: {result}")
@@ -177,6 +257,16 @@ class GeneratedImage(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Only rows still waiting for cleanup are indexed, so it stays small
+            models.Index(
+                fields=['expires_at'],
+                name='cleanup_due_idx',
+                condition=models.Q(is_expired=False, cleanup_attempted=False),
+            ),
+            # A user's history, newest first (ListGeneratedImagesView)
+            models.Index(fields=['user', 'created_at'], name='user_created_idx'),
+        ]
 
 
 class UsageSession(models.Model):
@@ -189,6 +279,12 @@ class UsageSession(models.Model):
     MAX_MATCHES = 1
     MAX_RANDOMIZES = 1
     
+    class Meta:
+        indexes = [
+            # The stale-row purge scans by age
+            models.Index(fields=['created_at'], name='usage_created_idx'),
+        ]
+    
     def __str__(self):
         return f"Session {self.session_key} - M:{self.matches_used}/{self.MAX_MATCHES} R:{self.randomizes_used}/{self.MAX_RANDOMIZES}"
     
@@ -204,17 +300,51 @@ class UsageSession(models.Model):
     def is_limited(self):
         return not self.can_match and not self.can_randomize
     
+    @classmethod
+    def _quota(cls, feature):
+        if feature == 'match':
+            return 'matches_used', cls.MAX_MATCHES
+        return 'randomizes_used', cls.MAX_RANDOMIZES
+
+    @classmethod
+    def consume(cls, feature, **lookup):
+        """
+        Atomically take one unit of quota for `feature` ('match' or 'randomize').
+        A single conditional UPDATE ... SET used = used + 1 WHERE used < MAX,
+        so concurrent requests can't both pass the limit. With a session_key
+        lookup a missing row is created already holding the unit.
+        Returns True if the quota was granted.
+        """
+        field, limit = cls._quota(feature)
+        under_limit = cls.objects.filter(**lookup, **{f"{field}__lt": limit})
+        if under_limit.update(**{field: F(field) + 1}):
+            return True
+
+        if 'session_key' not in lookup or limit < 1:
+            return False
+        try:
+            with transaction.atomic():
+                cls.objects.create(**lookup, **{field: 1})
+            return True
+        except IntegrityError:
+            # The row exists: either the quota is used up or a concurrent request just created it
+            return bool(under_limit.update(**{field: F(field) + 1}))
+
+    @classmethod
+    def refund(cls, feature, **lookup):
+        """Give back a unit taken by consume() when the work it paid for failed"""
+        field, _ = cls._quota(feature)
+        cls.objects.filter(**lookup, **{f"{field}__gt": 0}).update(**{field: F(field) - 1})
+
     def use_match(self):
-        if self.can_match:
-            self.matches_used += 1
-            self.save()
+        if type(self).consume('match', pk=self.pk):
+            self.refresh_from_db(fields=['matches_used'])
             return True
         return False
     
     def use_randomize(self):
-        if self.can_randomize:
-            self.randomizes_used += 1
-            self.save()
+        if type(self).consume('randomize', pk=self.pk):
+            self.refresh_from_db(fields=['randomizes_used'])
             return True
         return False
     
@@ -0,0 +1,211 @@
+# imagegen/pipeline.py - Small staged pipeline engine used by the generation paths
+
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineCancelled(Exception):
+    """Raised inside stages (via ctx.check_cancelled) once the run was cancelled"""
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    `func(ctx)` reads the names in `requires` from the context and returns a
+    dict with the names in `provides`. A stage becomes runnable as soon as
+    everything it requires is available, so stages without a dependency
+    between them run concurrently. `rollback(ctx)` undoes a completed stage
+    when a later one fails.
+    """
+
+    def __init__(self, name, func, requires=(), provides=(), retries=0, retry_delay=1.0, rollback=None):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.provides = tuple(provides)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.rollback = rollback
+
+    def __repr__(self):
+        return f"<Stage {self.name}>"
+
+
+class PipelineContext:
+    """Values flowing between stages, plus timings, cancellation and cleanups"""
+
+    def __init__(self, **values):
+        self.values = dict(values)
+        self.timings = {}
+        self._cancelled = threading.Event()
+        self._cleanups = []
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def update(self, values):
+        with self._lock:
+            self.values.update(values)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise PipelineCancelled()
+
+    def sleep(self, seconds):
+        """Interruptible sleep; returns False if the run was cancelled meanwhile"""
+        return not self._cancelled.wait(seconds)
+
+    def add_cleanup(self, func):
+        """Register a callable that runs when the pipeline finishes, success or not"""
+        with self._lock:
+            self._cleanups.append(func)
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order on a bounded thread pool.
+
+    On the first failure the context is cancelled, running stages are allowed
+    to finish, completed stages are rolled back in reverse order and the
+    original exception is re-raised. Per-stage wall time is recorded in
+    ctx.timings.
+    """
+
+    def __init__(self, name, stages, max_workers=2, on_event=None):
+        self.name = name
+        self.stages = list(stages)
+        self.max_workers = max_workers
+        # on_event(event, stage, ctx) with event in ('started', 'completed')
+        self.on_event = on_event
+
+    def _validate(self, ctx):
+        available = set(ctx.values)
+        for stage in self.stages:
+            available.update(stage.provides)
+        for stage in self.stages:
+            missing = [name for name in stage.requires if name not in available]
+            if missing:
+                raise ValueError(f"Stage {stage.name} requires {missing}, which nothing provides")
+
+    def _emit(self, event, stage, ctx):
+        if self.on_event:
+            try:
+                self.on_event(event, stage, ctx)
+            except Exception as e:
+                logger.warning(f"⚠️ Pipeline event hook failed for {stage.name}: {e}")
+
+    def _execute(self, stage, ctx, in_worker_thread):
+        started = time.monotonic()
+        try:
+            attempt = 0
+            while True:
+                ctx.check_cancelled()
+                try:
+                    self._emit('started', stage, ctx)
+                    result = stage.func(ctx) or {}
+                    break
+                except PipelineCancelled:
+                    raise
+                except Exception as e:
+                    if attempt >= stage.retries:
+                        raise
+                    attempt += 1
+                    logger.warning(f"🔁 {self.name}.{stage.name} failed ({e}), retry {attempt}/{stage.retries}")
+                    if not ctx.sleep(stage.retry_delay * attempt):
+                        raise PipelineCancelled()
+            return result
+        finally:
+            ctx.timings[stage.name] = round(time.monotonic() - started, 4)
+            if in_worker_thread:
+                # Worker threads get their own DB connections; don't leak them
+                connections.close_all()
+
+    def _rollback(self, completed, ctx):
+        for stage in reversed(completed):
+            if stage.rollback:
+                try:
+                    stage.rollback(ctx)
+                    logger.info(f"↩️ Rolled back {self.name}.{stage.name}")
+                except Exception as e:
+                    logger.error(f"❌ Rollback of {self.name}.{stage.name} failed: {e}")
+
+    def run(self, ctx):
+        self._validate(ctx)
+        pending = list(self.stages)
+        completed = []
+        running = {}
+        error = None
+        started = time.monotonic()
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"pipeline-{self.name}")
+        try:
+            while pending or running:
+                ready = [s for s in pending if all(name in ctx for name in s.requires)] if error is None else []
+
+                # A lone ready stage runs inline; the pool is only for real overlap
+                if len(ready) == 1 and not running:
+                    stage = ready[0]
+                    pending.remove(stage)
+                    try:
+                        ctx.update(self._execute(stage, ctx, in_worker_thread=False))
+                        completed.append(stage)
+                        self._emit('completed', stage, ctx)
+                    except Exception as e:
+                        error = e
+                        ctx.cancel()
+                    continue
+
+                for stage in ready[:max(0, self.max_workers - len(running))]:
+                    pending.remove(stage)
+                    running[executor.submit(self._execute, stage, ctx, True)] = stage
+
+                if not running:
+                    if error is None and pending:
+                        raise ValueError(f"Pipeline {self.name} stalled at {[s.name for s in pending]}")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        ctx.update(future.result())
+                        completed.append(stage)
+                        self._emit('completed', stage, ctx)
+                    except Exception as e:
+                        if error is None:
+                            error = e
+                        ctx.cancel()
+
+            if error is not None:
+                self._rollback(completed, ctx)
+                raise error
+
+            return ctx
+        finally:
+            executor.shutdown(wait=True)
+            for cleanup in reversed(ctx._cleanups):
+                try:
+                    cleanup()
+                except Exception as e:
+                    logger.error(f"❌ Pipeline cleanup failed: {e}")
+            logger.info(f"⏱️ {self.name} finished in {time.monotonic() - started:.2f}s: {ctx.timings}")
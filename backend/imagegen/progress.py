@@ -0,0 +1,149 @@
+# imagegen/progress.py - Lightweight progress pub/sub over the Django cache
+
+import json
+import time
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+logger = logging.getLogger(__name__)
+
+# Events live just long enough for a slow client to catch up
+PROGRESS_TTL = getattr(settings, 'PROGRESS_EVENT_TTL', 30 * 60)
+# A stream ends after this and the browser reconnects (retry + Last-Event-ID),
+# so one client never pins a server thread for a whole generation
+STREAM_TIMEOUT = getattr(settings, 'PROGRESS_STREAM_TIMEOUT', 60)
+RECONNECT_MS = 2000
+POLL_INTERVAL = getattr(settings, 'PROGRESS_POLL_INTERVAL', 0.5)
+KEEPALIVE_INTERVAL = 15
+
+TERMINAL_STAGES = ('completed', 'failed')
+
+
+def image_channel(image_id):
+    return f"imagegen:{image_id}"
+
+
+def faceswap_channel(job_id):
+    return f"faceswap:{job_id}"
+
+
+def _seq_key(channel):
+    return f"progress:{channel}:seq"
+
+
+def _event_key(channel, seq):
+    return f"progress:{channel}:{seq}"
+
+
+def publish(channel, stage, **data):
+    """
+    Append a stage event to a channel.
+    Events are numbered with an atomic cache counter so subscribers can resume.
+    """
+    try:
+        seq_key = _seq_key(channel)
+        cache.add(seq_key, 0, timeout=PROGRESS_TTL)
+        try:
+            seq = cache.incr(seq_key)
+        except ValueError:
+            # Counter expired between add() and incr()
+            cache.set(seq_key, 1, timeout=PROGRESS_TTL)
+            seq = 1
+        cache.touch(seq_key, PROGRESS_TTL)
+        cache.set(_event_key(channel, seq), {"stage": stage, **data}, timeout=PROGRESS_TTL)
+        return seq
+    except Exception as e:
+        # Progress is best effort and must never break the job itself
+        logger.warning(f"⚠️ Failed to publish {stage} on {channel}: {e}")
+        return None
+
+
+def read_events(channel, after=0):
+    """Return [(seq, event), ...] published after `after`, in order"""
+    last = cache.get(_seq_key(channel), 0)
+    if last <= after:
+        return []
+
+    keys = [_event_key(channel, seq) for seq in range(after + 1, last + 1)]
+    found = cache.get_many(keys)
+
+    events = []
+    for seq, key in zip(range(after + 1, last + 1), keys):
+        if key not in found:
+            # Published counter but event not written yet - pick it up next poll
+            break
+        events.append((seq, found[key]))
+    return events
+
+
+def format_event(seq, event):
+    lines = []
+    if seq is not None:
+        lines.append(f"id: {seq}")
+    lines.append(f"event: {event['stage']}")
+    lines.append(f"data: {json.dumps(event, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def event_stream(channel, last_event_id=0, snapshot=None):
+    """
+    Yield Server-Sent Events for a channel until a terminal stage or
+    STREAM_TIMEOUT. A timed-out stream just ends: EventSource reconnects after
+    `retry` and resumes from Last-Event-ID.
+    `snapshot` is the current state from the database, sent first so late
+    subscribers don't wait for an event that was already published.
+    """
+    yield f"retry: {RECONNECT_MS}\n\n"
+
+    if snapshot:
+        yield format_event(None, snapshot)
+        if snapshot.get("stage") in TERMINAL_STAGES:
+            return
+
+    after = last_event_id
+    started = time.monotonic()
+    last_sent = started
+
+    while time.monotonic() - started < STREAM_TIMEOUT:
+        for seq, event in read_events(channel, after):
+            after = seq
+            last_sent = time.monotonic()
+            yield format_event(seq, event)
+            if event.get("stage") in TERMINAL_STAGES:
+                return
+
+        if time.monotonic() - last_sent >= KEEPALIVE_INTERVAL:
+            last_sent = time.monotonic()
+            yield ": keep-alive\n\n"
+
+        time.sleep(POLL_INTERVAL)
+
+
+def last_event_id(request):
+    try:
+        return int(request.META.get('HTTP_LAST_EVENT_ID', 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def streaming_response(channel, request, snapshot=None):
+    response = StreamingHttpResponse(
+        event_stream(channel, last_event_id(request), snapshot),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets DRF content negotiation accept `Accept: text/event-stream`"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, default=str)
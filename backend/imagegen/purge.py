@@ -0,0 +1,60 @@
+# imagegen/purge.py - Batched, throttled deletion of stale anonymous usage and session rows
+
+import time
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+from .models import UsageSession
+
+logger = logging.getLogger(__name__)
+
+# UsageSession rows older than this are deleted (anonymous quotas reset anyway once the session is gone)
+RETENTION_DAYS = getattr(settings, 'USAGE_SESSION_RETENTION_DAYS', 30)
+# Rows per DELETE - small enough that each statement holds its locks only briefly
+BATCH_SIZE = getattr(settings, 'PURGE_BATCH_SIZE', 1000)
+# Pause between batches so the purge never monopolises the database
+BATCH_PAUSE = getattr(settings, 'PURGE_BATCH_PAUSE', 0.2)
+
+
+def purge_in_batches(queryset, label, batch_size=None, pause=None):
+    """
+    Delete `queryset` a batch at a time: select up to batch_size primary keys
+    (an index scan), delete exactly those, sleep, repeat until none are left.
+    Returns (rows deleted, rows per second).
+    """
+    batch_size = batch_size or BATCH_SIZE
+    pause = BATCH_PAUSE if pause is None else pause
+    model = queryset.model
+    started = time.monotonic()
+    deleted = 0
+
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        # No dependents or signals, so Django issues a single DELETE ... WHERE pk IN (...)
+        deleted += model.objects.filter(pk__in=pks).delete()[0]
+        if len(pks) < batch_size:
+            break
+        time.sleep(pause)
+
+    elapsed = time.monotonic() - started
+    rate = deleted / elapsed if elapsed > 0 else 0.0
+    logger.info(f"🗑️ Purged {deleted} {label} rows in {elapsed:.1f}s ({rate:.0f} rows/s)")
+    return deleted, rate
+
+
+def purge_usage_sessions(retention_days=None, **kwargs):
+    """Delete UsageSession rows created more than retention_days ago"""
+    days = RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = timezone.now() - timedelta(days=days)
+    stale = UsageSession.objects.filter(created_at__lt=cutoff).order_by('created_at')
+    return purge_in_batches(stale, 'UsageSession', **kwargs)
+
+
+def purge_expired_sessions(**kwargs):
+    """Delete expired django_session rows (what clearsessions does, but batched)"""
+    expired = Session.objects.filter(expire_date__lt=timezone.now()).order_by('expire_date')
+    return purge_in_batches(expired, 'django_session', **kwargs)
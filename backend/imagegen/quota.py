@@ -0,0 +1,216 @@
+# imagegen/quota.py - Pluggable anonymous usage quota backends
+
+import uuid
+import logging
+from functools import lru_cache
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from .models import UsageSession
+
+logger = logging.getLogger(__name__)
+
+QUOTA_BACKEND = getattr(settings, 'IMAGEGEN_QUOTA_BACKEND', 'imagegen.quota.DatabaseQuotaBackend')
+# How long a cache-backed quota (and its client token) lives
+QUOTA_TTL = getattr(settings, 'IMAGEGEN_QUOTA_TTL', 30 * 24 * 60 * 60)
+QUOTA_COOKIE = 'imagegen_quota'
+QUOTA_HEADER = 'X-Quota-Token'
+JOURNAL_TTL = 24 * 60 * 60
+FLUSH_BATCH_SIZE = 500
+
+
+class QuotaUsage:
+    """Counters for one client; same attributes as UsageSession so views can use either"""
+    MAX_MATCHES = UsageSession.MAX_MATCHES
+    MAX_RANDOMIZES = UsageSession.MAX_RANDOMIZES
+
+    def __init__(self, matches_used=0, randomizes_used=0):
+        self.matches_used = matches_used
+        self.randomizes_used = randomizes_used
+
+    @property
+    def can_match(self):
+        return self.matches_used < self.MAX_MATCHES
+
+    @property
+    def can_randomize(self):
+        return self.randomizes_used < self.MAX_RANDOMIZES
+
+    @property
+    def is_limited(self):
+        return not self.can_match and not self.can_randomize
+
+
+class QuotaBackend:
+    """
+    Where anonymous usage counters live. A client is identified by an opaque
+    string the backend derives from the request; features are 'match' and
+    'randomize'.
+    """
+
+    def client_id(self, request, create=False):
+        """The caller's client id, minting one if `create`; None if unknown"""
+        raise NotImplementedError
+
+    def consume(self, client_id, feature):
+        """Atomically take one unit of quota; True if granted"""
+        raise NotImplementedError
+
+    def refund(self, client_id, feature):
+        raise NotImplementedError
+
+    def usage(self, client_id):
+        """A UsageSession-like object with the client's counters"""
+        raise NotImplementedError
+
+    def finalize(self, request, response):
+        """Hook to hand the client its identity (cookie, header) on the way out"""
+        return response
+
+
+class DatabaseQuotaBackend(QuotaBackend):
+    """Counters on UsageSession rows keyed by the Django session (the original behaviour)"""
+
+    def client_id(self, request, create=False):
+        if not request.session.session_key:
+            if not create:
+                return None
+            request.session.create()
+            logger.debug(f"🔑 Created new session: {request.session.session_key}")
+        if create:
+            # FORCE session save to ensure it persists
+            request.session.save()
+        return request.session.session_key
+
+    def consume(self, client_id, feature):
+        return UsageSession.consume(feature, session_key=client_id)
+
+    def refund(self, client_id, feature):
+        UsageSession.refund(feature, session_key=client_id)
+
+    def usage(self, client_id):
+        if client_id is None:
+            return QuotaUsage()
+        return UsageSession.get_or_create_for_session(client_id)
+
+
+class CacheQuotaBackend(QuotaBackend):
+    """
+    Counters in the shared cache keyed by a signed client token, so the
+    middleware's hot path never touches the database. The token travels in
+    a cookie (or the X-Quota-Token header for clients without cookies).
+
+    Every grant is journalled; flush_to_database() copies the counters of
+    journalled clients to UsageSession for analytics (write-behind).
+    """
+
+    signer = signing.Signer(salt='imagegen.quota')
+
+    def client_id(self, request, create=False):
+        token = request.COOKIES.get(QUOTA_COOKIE) or request.META.get('HTTP_X_QUOTA_TOKEN')
+        if token:
+            try:
+                return self.signer.unsign(token)
+            except signing.BadSignature:
+                logger.warning("⚠️ Ignoring quota token with a bad signature")
+        if not create:
+            return None
+
+        client_id = uuid.uuid4().hex
+        request.quota_token = self.signer.sign(client_id)
+        return client_id
+
+    def _key(self, client_id, feature):
+        return f"quota:{client_id}:{feature}"
+
+    def consume(self, client_id, feature):
+        limit = UsageSession.MAX_MATCHES if feature == 'match' else UsageSession.MAX_RANDOMIZES
+        key = self._key(client_id, feature)
+        cache.add(key, 0, timeout=QUOTA_TTL)
+        try:
+            used = cache.incr(key)
+        except ValueError:
+            # Counter expired between add() and incr()
+            cache.add(key, 0, timeout=QUOTA_TTL)
+            used = cache.incr(key)
+
+        if used > limit:
+            cache.decr(key)
+            return False
+        self._journal(client_id)
+        return True
+
+    def refund(self, client_id, feature):
+        key = self._key(client_id, feature)
+        try:
+            if cache.decr(key) < 0:
+                cache.incr(key)
+        except ValueError:
+            pass  # Counter already expired; nothing to give back
+        self._journal(client_id)
+
+    def usage(self, client_id):
+        if client_id is None:
+            return QuotaUsage()
+        counters = cache.get_many([self._key(client_id, 'match'), self._key(client_id, 'randomize')])
+        return QuotaUsage(
+            matches_used=counters.get(self._key(client_id, 'match'), 0),
+            randomizes_used=counters.get(self._key(client_id, 'randomize'), 0),
+        )
+
+    def finalize(self, request, response):
+        token = getattr(request, 'quota_token', None)
+        if token:
+            response.set_cookie(QUOTA_COOKIE, token, max_age=QUOTA_TTL, httponly=True, samesite='Lax')
+            response[QUOTA_HEADER] = token
+        return response
+
+    # Write-behind journal, numbered like progress events so a flush can resume
+
+    def _journal(self, client_id):
+        if not getattr(settings, 'IMAGEGEN_QUOTA_WRITE_BEHIND', True):
+            return
+        try:
+            cache.add('quota:journal:seq', 0, timeout=None)
+            seq = cache.incr('quota:journal:seq')
+            cache.set(f"quota:journal:{seq}", client_id, timeout=JOURNAL_TTL)
+        except Exception as e:
+            # Analytics only; never fail a request over it
+            logger.warning(f"⚠️ Failed to journal quota usage: {e}")
+
+    def flush_to_database(self):
+        """Copy counters of every client journalled since the last flush into UsageSession"""
+        flushed = cache.get('quota:journal:flushed', 0)
+        head = cache.get('quota:journal:seq', 0)
+        if head <= flushed:
+            return 0
+
+        total = 0
+        for start in range(flushed + 1, head + 1, FLUSH_BATCH_SIZE):
+            seqs = range(start, min(start + FLUSH_BATCH_SIZE, head + 1))
+            client_ids = set(cache.get_many([f"quota:journal:{seq}" for seq in seqs]).values())
+            rows = []
+            for client_id in client_ids:
+                usage = self.usage(client_id)
+                rows.append(UsageSession(
+                    session_key=client_id,
+                    matches_used=usage.matches_used,
+                    randomizes_used=usage.randomizes_used,
+                ))
+            UsageSession.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['session_key'],
+                update_fields=['matches_used', 'randomizes_used'],
+            )
+            total += len(rows)
+
+        cache.set('quota:journal:flushed', head, timeout=None)
+        logger.info(f"💾 Wrote quota counters of {total} clients to UsageSession")
+        return total
+
+
+@lru_cache(maxsize=None)
+def get_quota_backend():
+    return import_string(QUOTA_BACKEND)()
@@ -1,8 +1,9 @@
 from celery import shared_task
 from django.core.management import call_command
-from django.utils import timezone
 from .models import GeneratedImage
+from .cloudinary_cleanup import cleanup_expired_images
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -10,18 +11,22 @@ logger = logging.getLogger(__name__)
 def cleanup_expired_images_task(self):
     """
     Celery task to clean up expired images from Cloudinary
-    Runs every 6 hours automatically
+    Runs daily as a safety net behind the per-bucket expiry tasks, unless a
+    background cleanup thread already holds cleanup leadership
     """
+    from .background_cleanup import LEADER_NAME, LEADER_TTL, mark_cleanup_run
+    from .concurrency import LeaderLease
+
+    leader = LeaderLease(LEADER_NAME, ttl=LEADER_TTL)
+    if not leader.acquire():
+        logger.info("⏭️ Skipping scheduled cleanup - another cleaner is the leader")
+        return "Another cleaner is the leader"
+
     try:
         logger.info("🧹 Starting scheduled cleanup of expired images")
         
         # Find expired images
-        now = timezone.now()
-        expired_images = GeneratedImage.objects.filter(
-            expires_at__lt=now,
-            is_expired=False,
-            cleanup_attempted=False
-        )
+        expired_images = GeneratedImage.objects.due_for_cleanup()
         
         count = expired_images.count()
         logger.info(f"📊 Found {count} expired images to clean up")
@@ -30,19 +35,10 @@ def cleanup_expired_images_task(self):
             logger.info("✅ No expired images found")
             return "No images to clean up"
         
-        # Process cleanup
-        deleted_count = 0
-        failed_count = 0
-        
-        for img in expired_images:
-            try:
-                deleted_files = img.expire_and_cleanup()
-                logger.info(f"✅ Cleaned up image {img.id}: {deleted_files}")
-                deleted_count += 1
-            except Exception as e:
-                logger.error(f"❌ Failed to cleanup image {img.id}: {e}")
-                failed_count += 1
+        # Bulk-delete through the Admin API, 100 files per call
+        deleted_count, failed_count = cleanup_expired_images(expired_images)
         
+        mark_cleanup_run()
         result = f"Cleanup complete: {deleted_count} deleted, {failed_count} failed"
         logger.info(f"🎉 {result}")
         return result
@@ -51,6 +47,28 @@ def cleanup_expired_images_task(self):
         logger.error(f"❌ Cleanup task failed: {exc}")
         # Retry with exponential backoff
         raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+    finally:
+        leader.release()
+
+@shared_task(bind=True, max_retries=3)
+def expire_bucket_task(self, bucket):
+    """
+    Clean up the images that expired in one hourly bucket; enqueued with an
+    ETA when the bucket's first image is created (see imagegen.expiry)
+    """
+    from .expiry import process_bucket, enqueue_bucket
+
+    if time.time() < bucket:
+        # An intermediate hop; keep the chain going until the bucket closes
+        enqueue_bucket(bucket)
+        return f"Expiry bucket {bucket} not due yet"
+
+    try:
+        cleaned, failed = process_bucket(bucket)
+    except Exception as exc:
+        logger.error(f"❌ Expiry bucket {bucket} failed: {exc}")
+        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+    return f"Expiry bucket {bucket}: {cleaned} cleaned, {failed} failed"
 
 @shared_task
 def manual_cleanup_task(force=False):
@@ -64,4 +82,53 @@ def manual_cleanup_task(force=False):
     else:
         # Normal cleanup
         call_command('cleanup_expired_images')
-        return "Manual cleanup completed"
\ No newline at end of file
+        return "Manual cleanup completed"
+
+@shared_task(bind=True, acks_late=True, max_retries=20)
+def process_generation_task(self, image_id, mode, quota_client=None, priority=None):
+    """
+    Run a queued face generation job (job mode of /generate/ and /randomize/)
+    """
+    from .generation import run_generation_job, fail_generation_job
+    from .concurrency import AdmissionRejected
+
+    logger.info(f"🚀 Processing generation job {image_id} ({mode})")
+    try:
+        return run_generation_job(image_id, mode, quota_client, max_wait=60, priority=priority)
+    except AdmissionRejected as rejected:
+        # Face swap capacity is full cluster-wide - come back when a slot should be free
+        if self.request.retries >= self.max_retries:
+            fail_generation_job(image_id, "Server busy. Please try again later.", mode, quota_client)
+            return False
+        logger.info(f"⏳ Generation job {image_id} waiting for capacity ({rejected.reason})")
+        raise self.retry(countdown=rejected.retry_after)
+
+
+@shared_task
+def flush_quota_usage_task():
+    """
+    Write-behind for the cache quota backend: copy recently changed counters
+    to UsageSession for analytics. No-op with the database backend.
+    """
+    from .quota import get_quota_backend, CacheQuotaBackend
+
+    backend = get_quota_backend()
+    if not isinstance(backend, CacheQuotaBackend):
+        return "Quota backend is not cache-based"
+    return f"Flushed {backend.flush_to_database()} quota counters"
+
+
+@shared_task
+def purge_stale_sessions_task():
+    """
+    Delete old UsageSession rows and expired django_session rows in small,
+    throttled batches. Runs daily.
+    """
+    from .purge import purge_usage_sessions, purge_expired_sessions
+
+    usage_deleted, usage_rate = purge_usage_sessions()
+    sessions_deleted, sessions_rate = purge_expired_sessions()
+    result = (f"Purged {usage_deleted} usage sessions ({usage_rate:.0f} rows/s), "
+              f"{sessions_deleted} expired sessions ({sessions_rate:.0f} rows/s)")
+    logger.info(f"🎉 {result}")
+    return result
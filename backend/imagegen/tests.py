@@ -1,3 +1,310 @@
-from django.test import TestCase
+import io
+import tracemalloc
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework import permissions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from . import cloudinary_cleanup
+from .cloudinary_cleanup import (
+    FakeCloudinary, MAX_IDS_PER_CALL, cleanup_batch, cleanup_expired_images, delete_public_ids,
+)
+from .concurrency import RateLimiter
+from .generation import MODE_MATCH, MODE_RANDOMIZE, build_pipeline
+from .idempotency import idempotent
+from .middleware import UsageLimitMiddleware
+from .models import GeneratedImage, UsageSession
+from .quota import get_quota_backend
+from .upload_handlers import SelfieUploadHandler, install_selfie_upload_handler
+from .utils import PreparedImage, _draft_box
+
+
+def unlimited_admin_api():
+    """The fake has no API budget to protect"""
+    return mock.patch.object(cloudinary_cleanup, 'admin_api_rate_limit', RateLimiter('cloudinary-fake', rate=10_000))
+
+
+def expired_image(n, **fields):
+    return GeneratedImage.objects.create(
+        prompt=f"You as Figure {n}",
+        match_name=f"Figure {n}",
+        selfie=f"uploads/selfies/selfie_{n}",
+        selfie_public_id=f"uploads/selfies/selfie_{n}",
+        output_image=f"uploads/fused/fused_{n}",
+        output_public_id=f"uploads/fused/fused_{n}",
+        status='completed',
+        expires_at=timezone.now() - timedelta(hours=1),
+        **fields,
+    )
+
+
+class DeletePublicIdsTests(SimpleTestCase):
+    public_ids = [f"uploads/selfies/selfie_{i}" for i in range(250)]
+
+    def setUp(self):
+        patcher = unlimited_admin_api()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sends_at_most_100_ids_per_call(self):
+        client = FakeCloudinary()
+        gone = delete_public_ids(self.public_ids + self.public_ids[:10], client)
+        self.assertEqual([len(call) for call in client.calls], [100, 100, 50])
+        self.assertTrue(all(len(call) <= MAX_IDS_PER_CALL for call in client.calls))
+        self.assertEqual(gone, set(self.public_ids))
+
+    def test_ids_left_out_of_a_partial_response_are_not_deleted(self):
+        client = FakeCloudinary(failing_ids=self.public_ids[5:8])
+        gone = delete_public_ids(self.public_ids, client)
+        self.assertEqual(gone, set(self.public_ids) - set(self.public_ids[5:8]))
+
+    def test_a_failed_call_only_loses_its_own_chunk(self):
+        client = FakeCloudinary()
+        client.error = RuntimeError("HTTP 500")
+        self.assertEqual(delete_public_ids(self.public_ids, client), set(self.public_ids[100:]))
+        # Retried ids that are already gone count as deleted
+        self.assertEqual(delete_public_ids(self.public_ids, client), set(self.public_ids))
+
+
+class CleanupBatchTests(TestCase):
+    def setUp(self):
+        patcher = unlimited_admin_api()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_marks_cleaned_rows_in_a_single_update(self):
+        images = [expired_image(n) for n in range(5)]
+        client = FakeCloudinary()
+        with self.assertNumQueries(1):
+            cleaned, failed = cleanup_batch(images, client)
+
+        self.assertEqual(sorted(cleaned), sorted(image.id for image in images))
+        self.assertEqual(failed, [])
+        self.assertEqual(len(client.calls), 1)
+        self.assertFalse(GeneratedImage.objects.due_for_cleanup().exists())
+
+    def test_rows_with_a_failed_file_stay_due(self):
+        images = [expired_image(n) for n in range(3)]
+        client = FakeCloudinary(failing_ids=[images[1].output_public_id])
+        cleaned, failed = cleanup_batch(images, client)
+
+        self.assertEqual(failed, [images[1].id])
+        self.assertEqual(list(GeneratedImage.objects.due_for_cleanup().values_list('id', flat=True)), [images[1].id])
+
+    def test_cleanup_run_skips_fresh_claims_and_takes_stale_ones(self):
+        unclaimed = expired_image(1)
+        stale = expired_image(2, cleanup_claimed_at=timezone.now() - timedelta(hours=1))
+        claimed = expired_image(3, cleanup_claimed_at=timezone.now())
+
+        cleaned, failed = cleanup_expired_images(client=FakeCloudinary(), workers=1)
+
+        self.assertEqual((cleaned, failed), (2, 0))
+        self.assertEqual(list(GeneratedImage.objects.due_for_cleanup().values_list('id', flat=True)), [claimed.id])
+        for image in (unclaimed, stale):
+            image.refresh_from_db()
+            self.assertTrue(image.is_expired)
+            self.assertIsNone(image.cleanup_claimed_at)
+
+
+class CleanupIndexTests(TestCase):
+    def test_due_for_cleanup_uses_the_partial_index(self):
+        expired_image(1)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # The test table is tiny; make the planner show which index it would pick
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        self.assertIn('cleanup_due_idx', GeneratedImage.objects.due_for_cleanup().explain())
+
+
+class SelfieAllocationTests(SimpleTestCase):
+    @staticmethod
+    def noisy_jpeg(width, height):
+        # Noise doesn't compress, so this is the worst case for every encode
+        pixels = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+        output = io.BytesIO()
+        Image.fromarray(pixels).save(output, 'JPEG', quality=90)
+        return output.getvalue()
+
+    @staticmethod
+    def buffer_path_peak(raw):
+        def buffer_path():
+            selfie_buffer = PreparedImage(io.BytesIO(raw)).buffer
+            selfie_buffer.sha256()
+            for _ in range(2):
+                with selfie_buffer.open() as reader:
+                    while reader.read(64 * 1024):
+                        pass
+
+        buffer_path()  # warm up imports and Pillow plugins
+        tracemalloc.start()
+        try:
+            buffer_path()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_buffer_path_peak_does_not_grow_with_the_upload(self):
+        small = self.noisy_jpeg(1600, 1200)
+        large = self.noisy_jpeg(3000, 4000)
+        small_peak = self.buffer_path_peak(small)
+        large_peak = self.buffer_path_peak(large)
+
+        # The decode is downscaled in draft mode and every consumer reads one
+        # buffer, so no copy of the (here ~10 MB) upload is ever made
+        self.assertLess(large_peak, len(large) // 2)
+        self.assertLess(large_peak, small_peak * 1.5)
+
+
+class DraftDecodeTests(SimpleTestCase):
+    @staticmethod
+    def jpeg(size, orientation=None):
+        output = io.BytesIO()
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        Image.new('RGB', size, 'white').save(output, 'JPEG', exif=exif.tobytes())
+        return Image.open(io.BytesIO(output.getvalue()))
+
+    def test_only_the_longer_side_covers_the_thumbnail(self):
+        img = self.jpeg((4000, 3000))
+        self.assertEqual(_draft_box(img, (800, 800)), (800, 600))
+        img.draft('RGB', _draft_box(img, (800, 800)))
+        self.assertEqual(img.size, (1000, 750))
+
+    def test_rotated_photos_swap_the_box(self):
+        # Stored 4000x3000 but shown 3000x4000: the thumbnail is 400x534, stored as 534x400
+        self.assertEqual(_draft_box(self.jpeg((4000, 3000), orientation=6), (400, 800)), (534, 400))
+        self.assertEqual(_draft_box(self.jpeg((4000, 3000)), (400, 800)), (400, 300))
+
+
+class AdmissionOrderTests(SimpleTestCase):
+    """The face swap slot is only requested once the swap's inputs are ready"""
+
+    @staticmethod
+    def admit_waits_for(pipeline):
+        providers = {name: stage for stage in pipeline.stages for name in stage.provides}
+        admit = next(stage for stage in pipeline.stages if stage.name == 'admit')
+        waits_for, pending = set(), list(admit.requires)
+        while pending:
+            stage = providers.get(pending.pop())
+            if stage is not None and stage.name not in waits_for:
+                waits_for.add(stage.name)
+                pending.extend(stage.requires)
+        return waits_for
+
+    def test_requests_admit_after_match_and_upload(self):
+        for deferred in (True, False):
+            self.assertLessEqual({'match', 'upload_selfie'},
+                                 self.admit_waits_for(build_pipeline(MODE_MATCH, deferred=deferred)))
+            self.assertIn('upload_selfie', self.admit_waits_for(build_pipeline(MODE_RANDOMIZE, deferred=deferred)))
+
+    def test_jobs_admit_after_match(self):
+        self.assertLessEqual({'load_selfie', 'match', 'record_match'},
+                             self.admit_waits_for(build_pipeline(MODE_MATCH, job=True)))
+
+
+class SelfieUploadHandlerTests(SimpleTestCase):
+    def test_default_handlers_never_open_a_file_for_the_selfie(self):
+        image = io.BytesIO()
+        Image.new('RGB', (640, 480), 'white').save(image, 'JPEG')
+        selfie = SimpleUploadedFile('selfie.jpg', image.getvalue(), content_type='image/jpeg')
+        request = RequestFactory().post('/api/imagegen/generate/', {'selfie': selfie})
+        install_selfie_upload_handler(request)
+
+        with mock.patch.object(TemporaryFileUploadHandler, 'new_file') as temporary, \
+                mock.patch.object(MemoryFileUploadHandler, 'new_file') as memory:
+            selfie = request.FILES['selfie']
+
+        temporary.assert_not_called()
+        memory.assert_not_called()
+        self.assertIsInstance(request.upload_handlers[0], SelfieUploadHandler)
+        self.assertEqual(selfie.size, len(image.getvalue()))
+
+
+class IdempotentQuotaTests(TestCase):
+    """An anonymous retry with the same Idempotency-Key is replayed without touching the quota"""
+
+    def setUp(self):
+        cache.clear()
+        self.executions = 0
+        test = self
+
+        class GenerateView(APIView):
+            permission_classes = [permissions.AllowAny]
+            authentication_classes = []
+
+            @idempotent
+            def post(self, request):
+                test.executions += 1
+                return Response({"id": test.executions}, status=201)
+
+        self.middleware = UsageLimitMiddleware(GenerateView.as_view())
+        self.session = SessionStore()
+        self.session.create()
+        patcher = mock.patch('imagegen.middleware.resolve', return_value=SimpleNamespace(url_name='generate-image'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, key):
+        request = RequestFactory().post('/api/imagegen/generate/', {'mode': 'match'}, HTTP_IDEMPOTENCY_KEY=key)
+        request.user = AnonymousUser()
+        request.session = self.session
+        return self.middleware(request)
+
+    def matches_used(self):
+        return UsageSession.objects.get(session_key=self.session.session_key).matches_used
+
+    def test_retry_is_replayed_without_spending_quota(self):
+        first = self.post('retry-key')
+        retry = self.post('retry-key')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.executions, 1)
+        self.assertEqual(self.matches_used(), 1)
+
+    def test_new_key_still_hits_the_limit(self):
+        self.post('first-key')
+        self.assertEqual(self.post('second-key').status_code, 429)
+        self.assertEqual(self.executions, 1)
+
+
+class EnqueueFailureTests(TestCase):
+    """A job that can't be queued (broker down) leaves nothing behind and refunds the quota"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_broker_failure_returns_503_and_discards_the_job(self):
+        image = io.BytesIO()
+        Image.new('RGB', (640, 480), 'white').save(image, 'JPEG')
+        selfie = SimpleUploadedFile('selfie.jpg', image.getvalue(), content_type='image/jpeg')
+        storage = GeneratedImage._meta.get_field('selfie').storage
+
+        with mock.patch.object(storage, 'save', return_value='uploads/selfies/selfie.webp'), \
+                mock.patch.object(storage, 'delete') as delete, \
+                mock.patch('imagegen.tasks.process_generation_task.delay', side_effect=OSError("broker down")):
+            response = self.client.post('/api/imagegen/generate/?async=1', {'selfie': selfie})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('error', response.json())
+        self.assertFalse(GeneratedImage.objects.exists())
+        delete.assert_called_once_with('uploads/selfies/selfie.webp')
+        # The quota client is the session the middleware created (a 5xx doesn't send its cookie)
+        client_id = Session.objects.get().session_key
+        self.assertEqual(get_quota_backend().usage(client_id).matches_used, 0)
@@ -0,0 +1,137 @@
+# imagegen/upload_handlers.py - Bounded-memory streaming upload handler for selfies
+
+import io
+import tempfile
+import logging
+from PIL import Image, UnidentifiedImageError
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger(__name__)
+
+# Hard cap on one selfie, checked against Content-Length and again while streaming
+MAX_UPLOAD_BYTES = getattr(settings, 'SELFIE_MAX_UPLOAD_BYTES', 15 * 1024 * 1024)
+# Uploads stay in memory up to this size, then roll over to a temp file
+SPOOL_THRESHOLD = getattr(settings, 'SELFIE_SPOOL_THRESHOLD', 2 * 1024 * 1024)
+# Decoded size limit - rejects decompression bombs before anything decodes pixels
+MAX_PIXELS = getattr(settings, 'SELFIE_MAX_PIXELS', 50_000_000)
+# Give up on finding an image header after this many bytes (large EXIF blocks fit)
+PROBE_BYTES = 256 * 1024
+# Room for the multipart boundaries and the other form fields
+MULTIPART_OVERHEAD = 64 * 1024
+ALLOWED_FORMATS = ('JPEG', 'MPO', 'PNG', 'WEBP')
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Selfie is too large."
+    default_code = 'upload_too_large'
+
+
+class InvalidSelfie(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = "Selfie must be a JPEG, PNG or WebP image."
+    default_code = 'invalid_selfie'
+
+
+class SelfieUploadHandler(FileUploadHandler):
+    """
+    Streams the `selfie` field into a spooled temp file instead of letting
+    Django buffer it whole.
+
+    - oversized requests are refused from Content-Length before the body is read
+    - the running byte count is enforced per chunk
+    - the image header is probed from the first chunks, rejecting non-images,
+      unsupported formats and decompression bombs early
+    - data lives in memory up to SPOOL_THRESHOLD, then on disk
+
+    Other fields fall through to the remaining upload handlers.
+    """
+
+    field_name = 'selfie'
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length and content_length > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD:
+            logger.warning(f"🚫 Rejected {content_length} byte upload before reading it")
+            raise UploadTooLarge(f"Selfie must be at most {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+        return None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.active = field_name == self.field_name
+        if self.active:
+            self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+            self.received = 0
+            self.head = io.BytesIO()
+            self.probed = False
+            # The selfie is ours alone; the default handlers must not open their own file for it
+            raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+
+        self.received += len(raw_data)
+        if self.received > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge(f"Selfie must be at most {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+
+        if not self.probed:
+            self._probe(raw_data)
+
+        self.file.write(raw_data)
+        return None
+
+    def _probe(self, raw_data):
+        """
+        Try to read the image header from what has arrived so far. Image.open
+        is lazy, so this only parses headers and never decodes pixels.
+        """
+        self.head.write(raw_data[:max(0, PROBE_BYTES - self.head.tell())])
+        self.head.seek(0)
+        try:
+            image = Image.open(self.head)
+        except Image.DecompressionBombError:
+            raise InvalidSelfie("Selfie resolution is too large.")
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            # Header incomplete - wait for more data unless we've seen enough
+            if self.received >= PROBE_BYTES:
+                raise InvalidSelfie()
+            self.head.seek(0, io.SEEK_END)
+            return
+
+        self.probed = True
+        self.head = None
+        if image.format not in ALLOWED_FORMATS:
+            raise InvalidSelfie()
+        width, height = image.size
+        if width * height > MAX_PIXELS:
+            logger.warning(f"🚫 Rejected {width}x{height} selfie (decompression bomb guard)")
+            raise InvalidSelfie(f"Selfie resolution {width}x{height} is too large.")
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        if not self.probed:
+            raise InvalidSelfie()
+
+        self.file.seek(0)
+        return UploadedFile(
+            file=self.file,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+    def upload_interrupted(self):
+        if getattr(self, 'active', False):
+            self.file.close()
+
+
+def install_selfie_upload_handler(request):
+    """Put SelfieUploadHandler first; must run before request.FILES is touched"""
+    request.upload_handlers.insert(0, SelfieUploadHandler(request))
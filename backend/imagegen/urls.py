@@ -2,6 +2,8 @@ from django.urls import path
 from .views import (
     GenerateImageView, 
     ImageStatusView, 
+    ImageProgressStreamView,
+    SwapCapacityView,
     UnlockImageView, 
     ListGeneratedImagesView,
     RandomizeImageView,
@@ -15,6 +17,8 @@ urlpatterns = [
     path("randomize/", RandomizeImageView.as_view(), name="randomize-image"),
     path("usage/", UsageStatusView.as_view(), name="usage-status"),
     path("status/<int:prediction_id>/", ImageStatusView.as_view(), name="image-status"),
+    path("progress/<int:prediction_id>/", ImageProgressStreamView.as_view(), name="image-progress"),
+    path("capacity/", SwapCapacityView.as_view(), name="swap-capacity"),
     path("unlock/", UnlockImageView.as_view(), name="unlock-generation"),
     path("list/", ListGeneratedImagesView.as_view(), name="list-images"),
 ]
\ No newline at end of file
@@ -1,29 +1,283 @@
-from PIL import Image
+from PIL import Image, ImageOps, ExifTags
 import io
+import math
+import hashlib
+import threading
+from collections import namedtuple
+import numpy as np
+from django.conf import settings
 from django.core.files.base import ContentFile
 
+try:
+    import pillow_avif  # noqa: F401 - registers AVIF with older Pillow releases
+except ImportError:
+    pass
+
+# Stored images are encoded in this format, at the highest quality that fits the budget
+OUTPUT_FORMAT = getattr(settings, 'IMAGEGEN_OUTPUT_FORMAT', 'webp')
+SELFIE_BYTE_BUDGET = getattr(settings, 'IMAGEGEN_SELFIE_BYTE_BUDGET', 120 * 1024)
+RESULT_BYTE_BUDGET = getattr(settings, 'IMAGEGEN_RESULT_BYTE_BUDGET', 250 * 1024)
+MIN_QUALITY = getattr(settings, 'IMAGEGEN_MIN_QUALITY', 40)
+MAX_QUALITY = getattr(settings, 'IMAGEGEN_MAX_QUALITY', 90)
+
+# name -> (Pillow format, file extension, content type)
+IMAGE_FORMATS = {
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+    'webp': ('WEBP', '.webp', 'image/webp'),
+    'avif': ('AVIF', '.avif', 'image/avif'),
+}
+
+
+class SelfieBuffer:
+    """
+    One owned buffer of encoded selfie bytes.
+
+    Consumers (hashing, face decoding, storage upload) get a memoryview or a
+    reader over the same memory instead of their own copy of the bytes.
+    """
+
+    def __init__(self, data):
+        # BytesIO(bytes) shares the bytes object until something writes to it
+        self._stream = data if isinstance(data, io.BytesIO) else io.BytesIO(data)
+        self.view = self._stream.getbuffer()
+
+    def __len__(self):
+        return self.view.nbytes
+
+    @property
+    def size(self):
+        return self.view.nbytes
+
+    def sha256(self):
+        return hashlib.sha256(self.view).hexdigest()
+
+    def open(self):
+        """Independent read-only file object; safe to use from several threads at once"""
+        return io.BufferedReader(MemoryViewReader(self.view))
+
+
+class MemoryViewReader(io.RawIOBase):
+    """Raw file object reading from a memoryview with its own position"""
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = chunk.nbytes
+        b[:n] = chunk
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self._view.nbytes + offset
+        self._pos = max(0, min(self._pos, self._view.nbytes))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+# EXIF orientations that turn the image by 90 degrees (width and height swap)
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _draft_box(img, max_size):
+    """
+    The size thumbnail(max_size) will produce, in the file's stored
+    orientation: only the side that limits the thumbnail has to be covered,
+    and an EXIF 90 degree turn swaps the box rather than padding it square.
+    """
+    width, height = img.size
+    rotated = img.getexif().get(ExifTags.Base.Orientation) in ROTATED_ORIENTATIONS
+    if rotated:
+        width, height = height, width
+    scale = min(max_size[0] / width, max_size[1] / height, 1)
+    box = (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+    return box[::-1] if rotated else box
+
+
+def _decode(image_file, max_size, draft=True):
+    """Decode, orient, flatten and downscale an upload to an RGB PIL image"""
+    img = Image.open(image_file)
+
+    # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale by libjpeg itself; draft()
+    # picks the smallest scale that still covers the thumbnail
+    # (a 4000x3000 photo decodes at 1000x750 for an 800 px selfie)
+    if draft and img.format in ('JPEG', 'MPO'):
+        img.draft('RGB', _draft_box(img, max_size))
+
+    # Phones store portrait shots rotated with an EXIF orientation tag
+    img = ImageOps.exif_transpose(img)
+
+    # Convert to RGB if necessary (removes alpha channels)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # Resize to reasonable dimensions
+    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+    return img
+
+
+def _encode_jpeg(image_file, max_size, quality, draft=True):
+    """Flatten, downscale and JPEG-encode an upload into a BytesIO"""
+    img = _decode(image_file, max_size, draft=draft)
+
+    # Compress
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=True)
+    output.seek(0)
+    return output
+
+
 def compress_image(image_file, max_size=(800, 800), quality=75):
     """Compress uploaded images to reduce memory usage"""
     try:
-        img = Image.open(image_file)
-        
-        # Convert to RGB if necessary (removes alpha channels)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            img = background
-        
-        # Resize to reasonable dimensions
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Compress
-        output = io.BytesIO()
-        img.save(output, format='JPEG', quality=quality, optimize=True)
-        output.seek(0)
-        
-        return ContentFile(output.getvalue())
+        return ContentFile(_encode_jpeg(image_file, max_size, quality).getvalue())
     except Exception as e:
         print(f"Compression error: {e}")
-        return image_file
\ No newline at end of file
+        return image_file
+
+
+EncodedImage = namedtuple('EncodedImage', ['buffer', 'format', 'quality', 'extension', 'content_type'])
+
+
+# Formats this Pillow (plus pillow_avif, if installed) can write - checked once, at import.
+# Image.SAVE rather than features.check(), which doesn't know 'avif' on older Pillow.
+Image.init()
+AVAILABLE_FORMATS = frozenset(
+    name for name, (pil_format, _, _) in IMAGE_FORMATS.items() if pil_format in Image.SAVE
+) | {'jpeg'}
+
+
+def format_available(name):
+    return name in AVAILABLE_FORMATS
+
+
+def _first_available(name):
+    for candidate in (name, 'webp', 'jpeg'):
+        if candidate in IMAGE_FORMATS and format_available(candidate):
+            return candidate
+    return 'jpeg'
+
+
+DEFAULT_FORMAT = _first_available(OUTPUT_FORMAT)
+
+
+def resolve_format(name=None):
+    """The requested (default: configured) format if this Pillow can write it, else WebP, else JPEG"""
+    return DEFAULT_FORMAT if name is None else _first_available(name)
+
+
+def _encode(img, pil_format, quality):
+    output = io.BytesIO()
+    options = {'quality': quality}
+    if pil_format == 'JPEG':
+        options['optimize'] = True
+    elif pil_format == 'WEBP':
+        options['method'] = 4
+    img.save(output, format=pil_format, **options)
+    return output
+
+
+def encode_to_budget(img, format_name=None, max_bytes=SELFIE_BYTE_BUDGET,
+                     min_quality=MIN_QUALITY, max_quality=MAX_QUALITY):
+    """
+    Encode `img` at the highest quality whose output fits in `max_bytes`,
+    binary searching between min_quality and max_quality. Most images fit at
+    max_quality, which is tried first, so the common case is a single encode.
+    Falls back to min_quality output when nothing fits.
+    """
+    format_name = resolve_format(format_name)
+    pil_format, extension, content_type = IMAGE_FORMATS[format_name]
+
+    best = None
+    output = _encode(img, pil_format, max_quality)
+    if output.tell() <= max_bytes:
+        best = (output, max_quality)
+    else:
+        low, high = min_quality, max_quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            output = _encode(img, pil_format, quality)
+            if output.tell() <= max_bytes:
+                best = (output, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is None:
+            best = (_encode(img, pil_format, min_quality), min_quality)
+
+    output, quality = best
+    output.seek(0)
+    return EncodedImage(SelfieBuffer(output), format_name, quality, extension, content_type)
+
+
+def encode_result(image_data, format_name=None, max_bytes=RESULT_BYTE_BUDGET):
+    """Re-encode swap output bytes into the storage format and budget"""
+    img = Image.open(io.BytesIO(image_data))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return encode_to_budget(img, format_name, max_bytes=max_bytes)
+
+
+class PreparedImage:
+    """
+    A selfie decoded exactly once.
+
+    `array` is the RGB NumPy array face detection runs on and `encoded` the
+    compressed image (an EncodedImage in the configured output format, whose
+    `buffer` is a SelfieBuffer) that gets stored; both come from the
+    same downscaled decode, so matching never sees JPEG artifacts and the
+    upload is never decoded twice. Both are built lazily and are safe to
+    read from concurrent pipeline stages.
+    """
+
+    def __init__(self, image_file, max_size=(800, 800), format_name=None, max_bytes=SELFIE_BYTE_BUDGET,
+                 draft=True):
+        self.image = _decode(image_file, max_size, draft=draft)
+        self.format_name = format_name
+        self.max_bytes = max_bytes
+        self._array = None
+        self._encoded = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def array(self):
+        with self._lock:
+            if self._array is None:
+                self._array = np.array(self.image)
+            return self._array
+
+    @property
+    def encoded(self):
+        with self._lock:
+            if self._encoded is None:
+                self._encoded = encode_to_budget(self.image, self.format_name, max_bytes=self.max_bytes)
+            return self._encoded
+
+    @property
+    def buffer(self):
+        return self.encoded.buffer
@@ -2,6 +2,8 @@ from .generation_views import GenerateImageView, RandomizeImageView
 from .management_views import (
     UsageStatusView, 
     ImageStatusView, 
+    ImageProgressStreamView,
+    SwapCapacityView,
     UnlockImageView, 
     ListGeneratedImagesView
 )
@@ -11,6 +13,8 @@ __all__ = [
     'RandomizeImageView', 
     'UsageStatusView',
     'ImageStatusView',
+    'ImageProgressStreamView',
+    'SwapCapacityView',
     'UnlockImageView',
     'ListGeneratedImagesView'
 ]
\ No newline at end of file
@@ -5,132 +5,69 @@ from rest_framework.response import Response
 from rest_framework import status, permissions
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from ..models import GeneratedImage, UsageSession
-from ..face_match import match_face
-from faceswap.huggingface_utils import FaceFusionClient
-import tempfile
-from django.core.files.base import ContentFile
-import os
-from django.core.files.uploadedfile import InMemoryUploadedFile
-import io
-from django.core.cache import cache
-from ..utils import compress_image
-from ..data.historical_figures import HISTORICAL_FIGURES, get_random_figure
-
-
-# 🔥 Memory management settings
-MAX_CONCURRENT_JOBS = 2  # Limit simultaneous face swaps
-
-
-@method_decorator(csrf_exempt, name='dispatch')
-class GenerateImageView(APIView):
+from ..data.historical_figures import get_random_figure
+from ..generation import (
+    MODE_MATCH,
+    MODE_RANDOMIZE,
+    GenerationError,
+    wants_async,
+    enqueue_generation,
+    generate_now,
+)
+from ..concurrency import AdmissionRejected
+from ..idempotency import idempotent
+from ..upload_handlers import install_selfie_upload_handler, UploadTooLarge, InvalidSelfie
+from ..middleware import release_usage_reservation
+
+
+def server_busy_response(rejected):
+    """503 carrying the caller's queue position and an ETA instead of a fixed delay"""
+    response = Response({
+        "error": "Server busy. Please try again shortly.",
+        "reason": rejected.reason,
+        "queue_position": rejected.position + 1,
+        "eta_seconds": round(rejected.eta_seconds),
+        "retry_after": rejected.retry_after,
+    }, status=503)
+    response['Retry-After'] = str(rejected.retry_after)
+    return response
+
+
+class BaseGenerationView(APIView):
+    """Shared plumbing for the generate/randomize endpoints"""
     permission_classes = [permissions.AllowAny]
+    failure_message = "Face processing failed"
+
+    def initialize_request(self, request, *args, **kwargs):
+        # Stream the selfie with bounded memory instead of Django's default buffering
+        install_selfie_upload_handler(request)
+        return super().initialize_request(request, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        # Rejected uploads keep the {"error": ...} shape of every other response here
+        if isinstance(exc, (UploadTooLarge, InvalidSelfie)):
+            return Response({"error": str(exc.detail)}, status=exc.status_code)
+        return super().handle_exception(exc)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Token-authenticated users look anonymous to UsageLimitMiddleware; give their quota back
+        if request.user.is_authenticated:
+            release_usage_reservation(request._request)
 
-    def post(self, request):
-        # Check server capacity
-        active_jobs = cache.get('active_face_swap_jobs', 0)
-        if active_jobs >= MAX_CONCURRENT_JOBS:
-            return Response({"error": "Server busy. Try again in 30 seconds.", "retry_after": 30}, status=503)
-
-        selfie = request.FILES.get("selfie")
-        if not selfie:
-            return Response({"error": "Selfie is required"}, status=400)
-
-        # Get usage session from middleware
-        usage_session = getattr(request, 'usage_session', None)
-        
-        # Compress image
-        compressed_selfie = compress_image(selfie)
-        selfie_content = compressed_selfie.read()
-        selfie_for_model = InMemoryUploadedFile(
-            file=io.BytesIO(selfie_content),
-            field_name='selfie',
-            name=f"compressed_{selfie.name}",
-            content_type='image/jpeg',
-            size=len(selfie_content),
-            charset=None,
-        )
-
-        # Save to temp file for face matching
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-            tmp.write(selfie_content)
-            tmp_path = tmp.name
-
-        temp_image = None
+    def run_generation(self, selfie, mode, **kwargs):
+        """Run the generation pipeline; returns (ctx, None) or (None, error Response)"""
         try:
-            # Increment job counter
-            cache.set('active_face_swap_jobs', active_jobs + 1, timeout=300)
-            
-            # Face matching
-            match_result = match_face(tmp_path)
-            if "error" in match_result:
-                return Response(match_result, status=status.HTTP_400_BAD_REQUEST)
-
-            match_name = match_result["match_name"]
-            match_score = match_result.get("score", 0)
-            
-            # Get historical image
-            historical_image_url = HISTORICAL_FIGURES.get(match_name)
-            if not historical_image_url:
-                return Response({"error": f"No historical image available for {match_name}"}, status=400)
-
-            # Create database record
-            temp_image = GeneratedImage.objects.create(
-                user=request.user if request.user.is_authenticated else None,
-                prompt=f"You as {match_name}",
-                match_name=match_name,
-                selfie=selfie_for_model,
-                output_url="",
+            ctx = generate_now(
+                selfie, mode, self.request.user, quota_client=getattr(self.request, 'quota_client', None), **kwargs
             )
-
-            # Face swap
-            class MockImageField:
-                def __init__(self, url):
-                    self.url = url
-
-            source_mock = MockImageField(temp_image.selfie.url)
-            target_mock = MockImageField(historical_image_url)
-
-            client = FaceFusionClient()
-            result_image_data = client.swap_faces(source_mock, target_mock)
-
-            # Save result
-            temp_image.output_image.save(
-                f"{temp_image.id}_fused_{match_name.replace(' ', '_')}.jpg", 
-                ContentFile(result_image_data)
-            )
-            temp_image.save()
-
-            # Update usage for anonymous users
-            if usage_session and not request.user.is_authenticated:
-                usage_session.use_match()
-
-            return Response({
-                "id": temp_image.id,
-                "match_name": match_name,
-                "match_score": round(match_score, 3),
-                "message": f"Successfully transformed you into {match_name}!",
-                "output_image_url": temp_image.output_image.url,
-                "original_selfie_url": temp_image.selfie.url,
-                "historical_figure_url": historical_image_url,
-                "usage": self.get_usage_data(request, usage_session)
-            })
-
+            return ctx, None
+        except AdmissionRejected as rejected:
+            return None, server_busy_response(rejected)
+        except GenerationError as e:
+            return None, Response(e.payload, status=e.status_code)
         except Exception as e:
-            if temp_image:
-                try:
-                    temp_image.delete()
-                except:
-                    pass
-            return Response({"error": f"Face processing failed: {str(e)}"}, status=500)
-        
-        finally:
-            current_jobs = cache.get('active_face_swap_jobs', 1)
-            cache.set('active_face_swap_jobs', max(0, current_jobs - 1), timeout=300)
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
+            return None, Response({"error": f"{self.failure_message}: {str(e)}"}, status=500)
 
     def get_usage_data(self, request, usage_session):
         if request.user.is_authenticated:
@@ -149,109 +86,100 @@ class GenerateImageView(APIView):
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class RandomizeImageView(APIView):
-    """Randomize with random historical figure"""
-    permission_classes = [permissions.AllowAny]
+class GenerateImageView(BaseGenerationView):
 
+    @idempotent
     def post(self, request):
-        # Check server capacity
-        active_jobs = cache.get('active_face_swap_jobs', 0)
-        if active_jobs >= MAX_CONCURRENT_JOBS:
-            return Response({"error": "Server busy. Try again in 30 seconds.", "retry_after": 30}, status=503)
-
         selfie = request.FILES.get("selfie")
         if not selfie:
             return Response({"error": "Selfie is required"}, status=400)
 
         # Get usage session from middleware
         usage_session = getattr(request, 'usage_session', None)
-        
-        # Pick random figure using the new helper function
-        random_figure, historical_image_url = get_random_figure()
-        
-        # Compress image
-        compressed_selfie = compress_image(selfie)
-        selfie_content = compressed_selfie.read()
-        selfie_for_model = InMemoryUploadedFile(
-            file=io.BytesIO(selfie_content),
-            field_name='selfie',
-            name=f"compressed_{selfie.name}",
-            content_type='image/jpeg',
-            size=len(selfie_content),
-            charset=None,
-        )
-
-        temp_image = None
-        try:
-            # Increment job counter
-            cache.set('active_face_swap_jobs', active_jobs + 1, timeout=300)
 
-            # Create database record
-            temp_image = GeneratedImage.objects.create(
-                user=request.user if request.user.is_authenticated else None,
-                prompt=f"You as {random_figure} (randomized)",
-                match_name=random_figure,
-                selfie=selfie_for_model,
-                output_url="",
-            )
+        # Job mode: validate, enqueue and let the client poll the status endpoint
+        if wants_async(request):
+            try:
+                job = enqueue_generation(
+                    selfie, MODE_MATCH, request.user, getattr(request, 'quota_client', None)
+                )
+            except GenerationError as e:
+                return Response(e.payload, status=e.status_code)
+            return Response({
+                "id": job.id,
+                "status": job.status,
+                "message": "Your transformation has been queued.",
+            }, status=status.HTTP_202_ACCEPTED)
+
+        ctx, error_response = self.run_generation(selfie, MODE_MATCH)
+        if error_response:
+            return error_response
+
+        image = ctx['image']
+        match_name = ctx['match_name']
+        return Response({
+            "id": image.id,
+            "match_name": match_name,
+            "match_score": round(ctx['match_score'], 3),
+            "message": f"Successfully transformed you into {match_name}!",
+            "output_image_url": image.output_delivery_url,
+            "original_selfie_url": image.selfie_delivery_url,
+            "historical_figure_url": ctx['historical_image_url'],
+            "usage": self.get_usage_data(request, usage_session)
+        })
 
-            # Face swap
-            class MockImageField:
-                def __init__(self, url):
-                    self.url = url
 
-            source_mock = MockImageField(temp_image.selfie.url)
-            target_mock = MockImageField(historical_image_url)
+@method_decorator(csrf_exempt, name='dispatch')
+class RandomizeImageView(BaseGenerationView):
+    """Randomize with random historical figure"""
+    failure_message = "Randomized face processing failed"
 
-            client = FaceFusionClient()
-            result_image_data = client.swap_faces(source_mock, target_mock)
+    @idempotent
+    def post(self, request):
+        selfie = request.FILES.get("selfie")
+        if not selfie:
+            return Response({"error": "Selfie is required"}, status=400)
 
-            # Save result
-            temp_image.output_image.save(
-                f"{temp_image.id}_randomized_{random_figure.replace(' ', '_')}.jpg", 
-                ContentFile(result_image_data)
-            )
-            temp_image.save()
+        # Get usage session from middleware
+        usage_session = getattr(request, 'usage_session', None)
 
-            # Update usage for anonymous users
-            if usage_session and not request.user.is_authenticated:
-                usage_session.use_randomize()
+        # Pick random figure using the new helper function
+        random_figure, historical_image_url = get_random_figure()
 
+        # Job mode: validate, enqueue and let the client poll the status endpoint
+        if wants_async(request):
+            try:
+                job = enqueue_generation(
+                    selfie, MODE_RANDOMIZE, request.user, getattr(request, 'quota_client', None),
+                    match_name=random_figure,
+                )
+            except GenerationError as e:
+                return Response(e.payload, status=e.status_code)
             return Response({
-                "id": temp_image.id,
+                "id": job.id,
+                "status": job.status,
                 "match_name": random_figure,
-                "match_score": 1.0,
-                "message": f"You've been randomly transformed into {random_figure}!",
-                "output_image_url": temp_image.output_image.url,
-                "original_selfie_url": temp_image.selfie.url,
                 "historical_figure_url": historical_image_url,
                 "is_randomized": True,
-                "usage": self.get_usage_data(request, usage_session)
-            })
-
-        except Exception as e:
-            if temp_image:
-                try:
-                    temp_image.delete()
-                except:
-                    pass
-            return Response({"error": f"Randomized face processing failed: {str(e)}"}, status=500)
-        
-        finally:
-            current_jobs = cache.get('active_face_swap_jobs', 1)
-            cache.set('active_face_swap_jobs', max(0, current_jobs - 1), timeout=300)
+                "message": "Your transformation has been queued.",
+            }, status=status.HTTP_202_ACCEPTED)
 
-    def get_usage_data(self, request, usage_session):
-        if request.user.is_authenticated:
-            return {"unlimited": True}
-        elif usage_session:
-            return {
-                "matches_used": usage_session.matches_used,
-                "matches_limit": usage_session.MAX_MATCHES,
-                "randomizes_used": usage_session.randomizes_used,
-                "randomizes_limit": usage_session.MAX_RANDOMIZES,
-                "can_match": usage_session.can_match,
-                "can_randomize": usage_session.can_randomize,
-                "is_limited": usage_session.is_limited,
-            }
-        return None
\ No newline at end of file
+        ctx, error_response = self.run_generation(
+            selfie, MODE_RANDOMIZE,
+            match_name=random_figure, historical_image_url=historical_image_url,
+        )
+        if error_response:
+            return error_response
+
+        image = ctx['image']
+        return Response({
+            "id": image.id,
+            "match_name": random_figure,
+            "match_score": 1.0,
+            "message": f"You've been randomly transformed into {random_figure}!",
+            "output_image_url": image.output_delivery_url,
+            "original_selfie_url": image.selfie_delivery_url,
+            "historical_figure_url": historical_image_url,
+            "is_randomized": True,
+            "usage": self.get_usage_data(request, usage_session)
+        })
@@ -3,7 +3,13 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import permissions
-from ..models import GeneratedImage, UsageSession
+from rest_framework.renderers import JSONRenderer
+from rest_framework.pagination import CursorPagination
+from django.conf import settings
+from ..models import GeneratedImage
+from ..quota import get_quota_backend
+from ..progress import EventStreamRenderer, image_channel, streaming_response
+from ..concurrency import face_swap_semaphore, face_swap_limit
 
 
 class UsageStatusView(APIView):
@@ -14,12 +20,10 @@ class UsageStatusView(APIView):
         if request.user.is_authenticated:
             return Response({"unlimited": True, "user_authenticated": True})
         
-        if not request.session.session_key:
-            request.session.create()
-            
-        usage_session = UsageSession.get_or_create_for_session(request.session.session_key)
+        backend = get_quota_backend()
+        usage_session = backend.usage(backend.client_id(request, create=True))
         
-        return Response({
+        response = Response({
             "matches_used": usage_session.matches_used,
             "matches_limit": usage_session.MAX_MATCHES,
             "randomizes_used": usage_session.randomizes_used,
@@ -29,22 +33,72 @@ class UsageStatusView(APIView):
             "is_limited": usage_session.is_limited,
             "user_authenticated": False
         })
+        return backend.finalize(request, response)
+
+
+def get_owned_image(request, prediction_id):
+    """
+    The image if the caller owns it, else None. Ids are sequential, so
+    anyone else's images read as not found rather than leaking their URLs.
+    """
+    generated_image = GeneratedImage.objects.filter(id=prediction_id).first()
+    if generated_image is None:
+        return None
+    if not generated_image.is_owned_by(request.user, get_quota_backend().client_id(request)):
+        return None
+    return generated_image
 
 
 class ImageStatusView(APIView):
     def get(self, request, prediction_id):
-        try:
-            generated_image = GeneratedImage.objects.get(id=prediction_id)
-            return Response({
-                "id": generated_image.id,
-                "status": "completed" if generated_image.output_image else "processing",
+        generated_image = get_owned_image(request, prediction_id)
+        if generated_image is None:
+            return Response({"error": "Generated image not found"}, status=404)
+        is_completed = generated_image.status == 'completed' and generated_image.output_image
+        return Response({
+            "id": generated_image.id,
+            "status": generated_image.status,
+            "error_message": generated_image.error_message or None,
+            "match_name": generated_image.match_name,
+            "prompt": generated_image.prompt,
+            "output_image_url": generated_image.output_delivery_url if is_completed else None,
+            "original_selfie_url": generated_image.selfie_delivery_url,
+            "created_at": generated_image.created_at
+        })
+
+
+class ImageProgressStreamView(APIView):
+    """Server-Sent Events stream of generation stages (replaces status polling), owner only"""
+    permission_classes = [permissions.AllowAny]
+    renderer_classes = [EventStreamRenderer, JSONRenderer]
+
+    def get(self, request, prediction_id):
+        generated_image = get_owned_image(request, prediction_id)
+        if generated_image is None:
+            return Response({"error": "Generated image not found"}, status=404)
+
+        snapshot = {"stage": generated_image.status, "id": generated_image.id}
+        if generated_image.status == 'completed' and generated_image.output_image:
+            snapshot.update({
                 "match_name": generated_image.match_name,
-                "prompt": generated_image.prompt,
-                "output_image_url": generated_image.output_image.url if generated_image.output_image else None,
-                "created_at": generated_image.created_at
+                "output_image_url": generated_image.output_delivery_url,
+                "original_selfie_url": generated_image.selfie_delivery_url,
             })
-        except GeneratedImage.DoesNotExist:
-            return Response({"error": "Generated image not found"}, status=404)
+        elif generated_image.status == 'failed':
+            snapshot["error"] = generated_image.error_message
+
+        return streaming_response(image_channel(generated_image.id), request, snapshot)
+
+
+class SwapCapacityView(APIView):
+    """Current adaptive face swap limit, slot usage and limit history (for dashboards)"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            "semaphore": face_swap_semaphore.stats(),
+            "adaptive_limit": face_swap_limit.snapshot(),
+        })
 
 
 class UnlockImageView(APIView):
@@ -53,19 +107,44 @@ class UnlockImageView(APIView):
         return Response({"message": "Unlock granted. You can generate again."})
 
 
+class GeneratedImageCursorPagination(CursorPagination):
+    """
+    Keyset pagination over (-created_at, id), served by the (user, created_at)
+    index; pages cost the same however deep the client scrolls.
+    """
+    ordering = ('-created_at', 'id')
+    page_size = getattr(settings, 'IMAGEGEN_HISTORY_PAGE_SIZE', 20)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'IMAGEGEN_HISTORY_MAX_PAGE_SIZE', 100)
+
+    def get_paginated_response(self, data):
+        return Response({
+            "images": data,
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+        })
+
+
 class ListGeneratedImagesView(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = GeneratedImageCursorPagination
     
     def get(self, request):
-        images = GeneratedImage.objects.filter(user=request.user).order_by('-created_at')
+        images = (
+            GeneratedImage.objects
+            .filter(user=request.user)
+            .only('id', 'match_name', 'prompt', 'output_image', 'output_url', 'selfie', 'selfie_url', 'created_at')
+        )
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(images, request, view=self)
         results = []
-        for img in images:
+        for img in page:
             results.append({
                 "id": img.id,
                 "match_name": img.match_name,
                 "prompt": img.prompt,
-                "output_image_url": img.output_image.url if img.output_image else None,
-                "selfie_url": img.selfie.url,
+                "output_image_url": img.output_delivery_url,
+                "selfie_url": img.selfie_delivery_url,
                 "created_at": img.created_at
             })
-        return Response({"images": results})
\ No newline at end of file
+        return paginator.get_paginated_response(results)
\ No newline at end of file
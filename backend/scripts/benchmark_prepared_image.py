@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark PreparedImage (what every generation request runs: decode, face
+array, encode to budget) with and without JPEG draft-mode decoding.
+
+Uses synthetic 12 MP (4000x3000) and 48 MP (8000x6000) photos, or your own:
+
+    python scripts/benchmark_prepared_image.py [photo.jpg ...] [--runs N]
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_project.settings.dev")
+
+import django  # noqa: E402
+
+django.setup()
+
+from imagegen.utils import PreparedImage, _draft_box  # noqa: E402
+
+MAX_SIZE = (800, 800)
+
+SYNTHETIC_SIZES = {
+    "12MP": (4000, 3000),
+    "48MP": (8000, 6000),
+}
+
+
+def synthetic_photo(size):
+    """Noisy gradient JPEG - compresses about like a real photo, unlike a flat fill"""
+    noise = Image.effect_noise(size, 40)
+    gradient = Image.linear_gradient('L').resize(size)
+    img = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def prepare(raw, draft):
+    prepared = PreparedImage(io.BytesIO(raw), MAX_SIZE, draft=draft)
+    prepared.array
+    prepared.encoded
+
+
+def decoded_size(raw, draft):
+    """Pixels libjpeg actually decodes before the thumbnail"""
+    img = Image.open(io.BytesIO(raw))
+    if draft:
+        img.draft('RGB', _draft_box(img, MAX_SIZE))
+    return img.size
+
+
+def run(raw, draft, runs):
+    """Median wall time of one PreparedImage"""
+    prepare(raw, draft)  # warm up Pillow plugins
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        prepare(raw, draft)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PreparedImage draft decoding")
+    parser.add_argument('photos', nargs='*', help="JPEG files to use instead of synthetic photos")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.photos:
+        samples = {Path(p).name: Path(p).read_bytes() for p in args.photos}
+    else:
+        print("🎨 Generating synthetic photos...")
+        samples = {label: synthetic_photo(size) for label, size in SYNTHETIC_SIZES.items()}
+
+    for label, raw in samples.items():
+        full_width, full_height = decoded_size(raw, draft=False)
+        draft_width, draft_height = decoded_size(raw, draft=True)
+        full_time = run(raw, draft=False, runs=args.runs)
+        draft_time = run(raw, draft=True, runs=args.runs)
+        print(f"📷 {label} ({len(raw) / 1024 / 1024:.1f} MB, median of {args.runs})")
+        print(f"  full decode:  {full_time * 1000:7.0f} ms  ({full_width}x{full_height})")
+        print(f"  draft decode: {draft_time * 1000:7.0f} ms  ({draft_width}x{draft_height})")
+        print(f"  speedup:      {full_time / draft_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
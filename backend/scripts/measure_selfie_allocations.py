@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Measure bytes allocated per selfie on its way from upload to storage.
+
+Compares the old copy-per-consumer path (ContentFile -> .read() -> BytesIO ->
+temp file) with the PreparedImage / SelfieBuffer path, using tracemalloc.
+
+    python scripts/measure_selfie_allocations.py path/to/selfie.jpg [runs]
+"""
+
+import io
+import os
+import sys
+import hashlib
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from imagegen.utils import compress_image, PreparedImage  # noqa: E402
+
+
+def consume(reader):
+    """Stand-in for a storage upload / face decode reading in chunks"""
+    while reader.read(64 * 1024):
+        pass
+
+
+def copying_path(raw):
+    content = compress_image(io.BytesIO(raw)).read()
+    hashlib.sha256(content).hexdigest()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
+        tmp.write(content)
+    with open(tmp.name, 'rb') as f:
+        consume(f)
+    os.unlink(tmp.name)
+    consume(io.BytesIO(content))
+
+
+def buffer_path(raw):
+    selfie_buffer = PreparedImage(io.BytesIO(raw)).buffer
+    selfie_buffer.sha256()
+    with selfie_buffer.open() as f:
+        consume(f)
+    with selfie_buffer.open() as f:
+        consume(f)
+
+
+def measure(func, raw, runs):
+    func(raw)  # warm up imports and PIL plugins
+    peaks = []
+    for _ in range(runs):
+        tracemalloc.start()
+        func(raw)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+    return sum(peaks) / len(peaks)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    raw = Path(sys.argv[1]).read_bytes()
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print(f"📷 {sys.argv[1]}: {len(raw) / 1024:.0f} KiB, {runs} runs")
+    copying = measure(copying_path, raw, runs)
+    buffered = measure(buffer_path, raw, runs)
+    print(f"  copying path:  {copying / 1024:.0f} KiB peak")
+    print(f"  buffer path:   {buffered / 1024:.0f} KiB peak")
+    print(f"  saved:         {(copying - buffered) / 1024:.0f} KiB per request")
+
+
+if __name__ == "__main__":
+    main()